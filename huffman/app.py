@@ -1,9 +1,52 @@
-from flask import Flask, request, send_file, url_for
+from flask import Flask, Response, jsonify, request, send_file, stream_with_context, url_for
 from werkzeug.utils import secure_filename, redirect
+import functools
 import os
 
 application = Flask(__name__)
+application.config.from_mapping(
+    SAVE_PATH=os.environ.get('HUFFMAN_SAVE_PATH', '/path/to/save'),
+    JOB_WORKERS=None,  # one per CPU
+    MAX_PENDING_JOBS=32,
+    MAX_JOB_BYTES=1 << 30,
+    JOB_TTL=3600,  # seconds a finished job's files are kept
+    CACHE_MAX_BYTES=1 << 30,
+    TRACE_MEMORY=False,  # log peak allocation per stage; slows requests down
+)
+import blocks
+import cache
 import compress2
+import jobs
+
+_job_queue = None
+_result_cache = None
+
+
+def get_job_queue():
+    """
+    Returns the background job queue, starting its process pool on first use.
+    :return:
+    """
+    global _job_queue
+    if _job_queue is None:
+        config = application.config
+        _job_queue = jobs.JobQueue(os.path.join(config['SAVE_PATH'], 'jobs'),
+                                   config['JOB_WORKERS'], config['MAX_PENDING_JOBS'],
+                                   config['MAX_JOB_BYTES'], config['JOB_TTL'])
+    return _job_queue
+
+
+def get_result_cache():
+    """
+    Returns the cache of finished results, kept in SAVE_PATH/cache.
+    :return:
+    """
+    global _result_cache
+    if _result_cache is None:
+        config = application.config
+        _result_cache = cache.ResultCache(os.path.join(config['SAVE_PATH'], 'cache'),
+                                          config['CACHE_MAX_BYTES'])
+    return _result_cache
 
 @application.route('/')
 def home():
@@ -26,36 +69,147 @@ def home():
 def upload():
     """
     Uploads a file and compresses it using the Huffman encoding algorithm.
-    If the file is a .huff file, it decompresses it.
+    If the file is a .huff file, single-stream or blocks (as /stream writes),
+    it decompresses it; a damaged one gets a 400.
+    Results are cached by the hash of the upload, so the same file uploaded again
+    is not compressed again. The time and bytes of each stage are logged.
     :return:
     """
     file = request.files['file']
     if file:
         filename = secure_filename(file.filename)
-        save_path = "/path/to/save"
+        save_path = application.config['SAVE_PATH']
         if not os.path.exists(save_path):
             os.makedirs(save_path)
-        file.save(os.path.join(save_path, filename))
+        digest = cache.save_and_hash(file.stream, os.path.join(save_path, filename))
 
         if filename.endswith('.huff'):
-            original_filename = filename.rsplit('.', 1)[0]  # Remove the .huff extension
-            compress2.decompress_file(os.path.join(save_path, filename),
-                                      os.path.join(save_path, original_filename))
-            return redirect(url_for('download', filename=original_filename))
+            result_filename = filename.rsplit('.', 1)[0]  # Remove the .huff extension
+            operation = 'decompress'
+            run = functools.partial(blocks.decompress_file_any, workers=1)
         else:
-            compress2.compress_file(os.path.join(save_path, filename), os.path.join(save_path, filename + ".huff"))
-            return redirect(url_for('download', filename=filename + ".huff"))
+            result_filename = filename + ".huff"
+            operation, run = 'compress', compress2.compress_file
+        result_path = os.path.join(save_path, result_filename)
+        key = cache.cache_key(digest, operation)
+        if get_result_cache().copy_to(key, result_path):
+            application.logger.info('%s %s: cache hit', operation, filename)
+        else:
+            try:
+                with compress2.record_stages(
+                        trace_memory=application.config['TRACE_MEMORY']) as stats:
+                    run(os.path.join(save_path, filename), result_path)
+            except (ValueError, IndexError) as e:
+                return f'{e}\n', 400
+            application.logger.info('%s %s: %.1f ms (%s)', operation, filename,
+                                    stats.total_seconds() * 1000, stats)
+            get_result_cache().put(key, result_path)
+        return redirect(url_for('download', filename=result_filename))
     else:
         return "No file uploaded!"
 
 
+@application.route('/stream/<filename>', methods=['POST'])
+def stream(filename):
+    """
+    Compresses the raw request body, or decompresses it if filename is a .huff file,
+    and streams the result back as it is produced. Nothing is saved to disk and at
+    most one block of the upload is held in memory, e.g.
+    curl --data-binary @log.txt http://host/stream/log.txt > log.txt.huff
+    :return:
+    """
+    filename = secure_filename(filename)
+    chunks = iter(lambda: request.stream.read(compress2.CHUNK_SIZE), b'')
+    if filename.endswith('.huff'):
+        body = blocks.decompress_stream_any(chunks)
+        download_name = filename.rsplit('.', 1)[0]  # Remove the .huff extension
+    else:
+        # a single pass over the body only allows blocks with their own trees
+        body = blocks.compress_stream(chunks)
+        download_name = filename + '.huff'
+    return Response(stream_with_context(body), mimetype='application/octet-stream',
+                    headers={'Content-Disposition': f'attachment; filename={download_name}'})
+
+
 @application.route('/download/<filename>')
 def download(filename):
     # Ensure the file exists.
-    if os.path.exists(os.path.join("/path/to/save", filename)):
-        return send_file(os.path.join("/path/to/save", filename), as_attachment=True)
+    save_path = application.config['SAVE_PATH']
+    if os.path.exists(os.path.join(save_path, filename)):
+        return send_file(os.path.join(save_path, filename), as_attachment=True)
     else:
         return "File not found!"
 
+
+@application.route('/metrics')
+def metrics():
+    """
+    Cache hit/miss counters in the Prometheus text format.
+    :return:
+    """
+    return Response(get_result_cache().metrics(), mimetype='text/plain; version=0.0.4')
+
+
+@application.route('/jobs', methods=['POST'])
+def submit_job():
+    """
+    Queues the uploaded file to be compressed (or decompressed if it is a .huff file)
+    in the background and returns the job id right away.
+    Answers 413 if the upload is too large and 503 if too many jobs are pending.
+    :return:
+    """
+    file = request.files.get('file')
+    if not file:
+        return jsonify(error="No file uploaded!"), 400
+    try:
+        job_id = get_job_queue().submit(file, secure_filename(file.filename),
+                                        request.content_length)
+    except jobs.JobTooLarge as e:
+        return jsonify(error=str(e)), 413
+    except jobs.JobQueueFull as e:
+        return jsonify(error=str(e)), 503, {'Retry-After': '5'}
+    return jsonify(id=job_id, status=url_for('job_status', job_id=job_id)), 202
+
+
+@application.route('/jobs/<job_id>')
+def job_status(job_id):
+    """
+    Returns the status of a job: queued, running, done or failed.
+    :return:
+    """
+    status = get_job_queue().status(job_id)
+    if status is None:
+        return jsonify(error="Job not found!"), 404
+    if status['status'] == jobs.DONE:
+        status['download'] = url_for('job_download', job_id=job_id)
+    return jsonify(status)
+
+
+@application.route('/jobs/<job_id>/progress')
+def job_progress(job_id):
+    """
+    Returns the fraction of a job that is done, from 0 to 1.
+    :return:
+    """
+    if get_job_queue().get(job_id) is None:
+        return jsonify(error="Job not found!"), 404
+    return jsonify(id=job_id, progress=get_job_queue().progress(job_id))
+
+
+@application.route('/jobs/<job_id>/download')
+def job_download(job_id):
+    """
+    Sends the result of a finished job.
+    :return:
+    """
+    queue = get_job_queue()
+    status = queue.status(job_id)
+    if status is None:
+        return jsonify(error="Job not found!"), 404
+    if status['status'] != jobs.DONE:
+        return jsonify(status), 409
+    job = queue.get(job_id)
+    return send_file(job.dst, as_attachment=True, download_name=job.result_name)
+
 if __name__ == '__main__':
     application.run(debug=True)
\ No newline at end of file
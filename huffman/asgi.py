@@ -0,0 +1,409 @@
+"""
+ASGI version of the compression web service in app.py.
+
+The Flask app holds a worker for the whole of every request, including the
+time a slow client takes to send its upload. Here one event loop holds all
+the connections: request bodies are read as the client sends them, and
+compress2 and blocks run on a process pool, so a slow client costs a
+coroutine instead of a thread or a worker process. Routes:
+
+    POST /upload/<filename>  compress the request body (or decompress it,
+                             for a .huff file) and send back the result;
+                             results are cached like in app.py
+    POST /stream/<filename>  like /stream in app.py: the body is compressed
+                             into a block file, or a block .huff body is
+                             decompressed, each block on the pool as soon
+                             as it has arrived; a single-stream .huff body
+                             is decompressed once it is all there
+    GET /metrics             cache counters in the Prometheus text format
+
+Run with:  uvicorn asgi:app --port 8001
+"""
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import (Any, AsyncIterable, AsyncIterator, Awaitable, Callable,
+                    Optional)
+
+from werkzeug.utils import secure_filename
+
+import blocks
+import cache
+import compress2
+
+CONFIG = {
+    'SAVE_PATH': os.environ.get('HUFFMAN_SAVE_PATH', '/path/to/save'),
+    'WORKERS': None,  # one per CPU
+    'CACHE_MAX_BYTES': 1 << 30,
+    # blocks of one /stream request on the pool at once
+    'STREAM_BLOCKS_AHEAD': 4,
+}
+
+logger = logging.getLogger(__name__)
+
+Message = dict[str, Any]
+Receive = Callable[[], Awaitable[Message]]
+Send = Callable[[Message], Awaitable[None]]
+
+_pool = None
+_result_cache = None
+
+
+class ClientDisconnected(Exception):
+    """ Raised when the client goes away before its request body is read."""
+
+
+def get_pool() -> ProcessPoolExecutor:
+    """ Return the process pool the compression runs on, started on first
+    use.
+    """
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(CONFIG['WORKERS'])
+    return _pool
+
+
+def get_result_cache() -> cache.ResultCache:
+    """ Return the cache of finished results, kept in SAVE_PATH/cache."""
+    global _result_cache
+    if _result_cache is None:
+        _result_cache = cache.ResultCache(
+            os.path.join(CONFIG['SAVE_PATH'], 'cache'),
+            CONFIG['CACHE_MAX_BYTES'])
+    return _result_cache
+
+
+async def read_body(receive: Receive) -> AsyncIterator[bytes]:
+    """ Yield the chunks of the request body as the client sends them."""
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            raise ClientDisconnected()
+        if message.get('body'):
+            yield message['body']
+        if not message.get('more_body'):
+            return
+
+
+class BodyReader:
+    """ A request body read as the client sends it. fill() waits for bytes
+    to arrive; read() then hands them to the synchronous readers in
+    compress2 and blocks, like compress2.ChunkReader does for a synchronous
+    stream. Iterating over a BodyReader yields the chunks that were not read
+    yet.
+    """
+    def __init__(self, receive: Receive) -> None:
+        self._chunks = read_body(receive)
+        self._buf = bytearray()
+
+    async def fill(self, n: int) -> None:
+        """ Wait until <n> bytes are buffered or the body has ended."""
+        while len(self._buf) < n:
+            try:
+                self._buf += await self._chunks.__anext__()
+            except StopAsyncIteration:
+                break
+
+    def peek(self, n: int) -> bytes:
+        """ Return the next <n> buffered bytes without consuming them."""
+        return bytes(self._buf[:n])
+
+    def read(self, n: int) -> bytes:
+        """ Return the next <n> buffered bytes, or fewer if fewer are
+        buffered.
+        """
+        result = bytes(self._buf[:n])
+        del self._buf[:n]
+        return result
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        if self._buf:
+            yield bytes(self._buf)
+            self._buf.clear()
+        async for chunk in self._chunks:
+            yield chunk
+
+
+async def save_body(chunks: AsyncIterable[bytes], path: str) -> str:
+    """ Copy the request body <chunks> to the file <path> and return the hex
+    SHA-256 of its bytes, like cache.save_and_hash.
+    """
+    # the writes go to the default thread pool: a slow disk would otherwise
+    # hold up every connection on the event loop
+    loop = asyncio.get_running_loop()
+    digest = hashlib.sha256()
+    with open(path, 'wb') as f:
+        async for chunk in chunks:
+            digest.update(chunk)
+            await loop.run_in_executor(None, f.write, chunk)
+    return digest.hexdigest()
+
+
+async def send_response(send: Send, status: int, body: bytes = b'',
+                        content_type: str = 'text/plain') -> None:
+    """ Send a whole response with <status> and <body>."""
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', content_type.encode()),
+                            (b'content-length', str(len(body)).encode())]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def start_download(send: Send, download_name: str,
+                         size: Optional[int] = None) -> None:
+    """ Start a 200 response with an attachment named <download_name> of
+    <size> bytes, or of unknown size.
+    """
+    headers = [(b'content-type', b'application/octet-stream'),
+               (b'content-disposition',
+                f'attachment; filename={download_name}'.encode())]
+    if size is not None:
+        headers.append((b'content-length', str(size).encode()))
+    await send({'type': 'http.response.start', 'status': 200,
+                'headers': headers})
+
+
+async def send_file(send: Send, path: str, download_name: str) -> None:
+    """ Send the file <path> as an attachment named <download_name>."""
+    loop = asyncio.get_running_loop()
+    with open(path, 'rb') as f:
+        await start_download(send, download_name, os.fstat(f.fileno()).st_size)
+        # read off the event loop, like the writes in save_body
+        while True:
+            chunk = await loop.run_in_executor(None, f.read,
+                                               compress2.CHUNK_SIZE)
+            if not chunk:
+                break
+            await send({'type': 'http.response.body', 'body': chunk,
+                        'more_body': True})
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+def run_file(operation: str, src: str, dst: str) -> str:
+    """ Compress or decompress <src> into <dst> in a worker process, and
+    return the time and stages it took, for the log.
+    """
+    with compress2.record_stages() as stats:
+        if operation == 'decompress':
+            # block files, as /stream writes them, or single-stream files
+            blocks.decompress_file_any(src, dst, workers=1)
+        else:
+            compress2.compress_file(src, dst)
+    return f'{stats.total_seconds() * 1000:.1f} ms ({stats})'
+
+
+def decompress_stream_file(src: str, dst: str) -> None:
+    """ Decompress the block or single-stream file <src> into <dst>, in a
+    worker process.
+    """
+    with open(src, 'rb') as f, open(dst, 'wb') as g:
+        chunks = compress2.read_chunks(f, compress2.CHUNK_SIZE)
+        for piece in blocks.decompress_stream_any(chunks):
+            g.write(piece)
+
+
+def _result_name(filename: str) -> tuple[str, str]:
+    """ Return the operation for the upload <filename> and the name of its
+    result.
+
+    >>> _result_name('log.txt'), _result_name('log.txt.huff')
+    (('compress', 'log.txt.huff'), ('decompress', 'log.txt'))
+    """
+    if filename.endswith('.huff'):
+        return 'decompress', filename.rsplit('.', 1)[0]
+    return 'compress', filename + '.huff'
+
+
+async def upload(receive: Receive, send: Send, filename: str) -> None:
+    """ Compress or decompress the request body and send the result. The
+    upload and result are kept under unique names while the request runs, so
+    concurrent uploads of the same filename do not overwrite each other.
+    """
+    loop = asyncio.get_running_loop()
+    operation, result_name = _result_name(filename)
+    save_path = CONFIG['SAVE_PATH']
+    os.makedirs(save_path, exist_ok=True)
+    work_dir = tempfile.mkdtemp(dir=save_path)
+    try:
+        src = os.path.join(work_dir, filename)
+        dst = os.path.join(work_dir, result_name)
+        key = cache.cache_key(await save_body(read_body(receive), src),
+                              operation)
+        result_cache = get_result_cache()
+        # copied rather than sent from the cache, which may evict it while
+        # it is being sent
+        if await loop.run_in_executor(None, result_cache.copy_to, key, dst):
+            logger.info('%s %s: cache hit', operation, filename)
+        else:
+            try:
+                timing = await loop.run_in_executor(get_pool(), run_file,
+                                                    operation, src, dst)
+            except (ValueError, IndexError) as e:
+                await send_response(send, 400, f'{e}\n'.encode())
+                return
+            logger.info('%s %s: %s', operation, filename, timing)
+            await loop.run_in_executor(None, result_cache.put, key, dst)
+        await send_file(send, dst, result_name)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+async def stream_decompress_blocks(body: BodyReader, send: Send,
+                                   result_name: str) -> None:
+    """ Decompress the block file <body>, decoding each frame on the pool as
+    soon as it has arrived and sending the blocks in order. A bad header
+    gets a 400 response; a bad frame further on ends the response early,
+    like in app.py.
+    """
+    loop, pool = asyncio.get_running_loop(), get_pool()
+    # a valid header is never longer, so reading it from the buffer only
+    # runs short on a bad one
+    await body.fill(blocks.MAX_HEADER_BYTES)
+    try:
+        flags, _, shared = blocks.read_block_header(body)
+    except ValueError as e:
+        await send_response(send, 400, f'{e}\n'.encode())
+        return
+    checksum = bool(flags & blocks.FLAG_CHECKSUM)
+    await start_download(send, result_name)
+    pending = deque()
+
+    async def send_block() -> None:
+        await send({'type': 'http.response.body', 'more_body': True,
+                    'body': await pending.popleft()})
+
+    while True:
+        await body.fill(blocks.FRAME_HEADER_BYTES)
+        kind, size, compressed_size = blocks.read_frame_header(body)
+        if kind == blocks.BLOCK_END:
+            break
+        await body.fill(compressed_size)
+        payload = compress2.read_exactly(body, compressed_size)
+        pending.append(loop.run_in_executor(pool, blocks.decode_block, kind,
+                                            payload, size, shared, checksum))
+        if len(pending) > CONFIG['STREAM_BLOCKS_AHEAD']:
+            await send_block()
+    while pending:
+        await send_block()
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+async def decompress_saved(body: BodyReader, send: Send, filename: str,
+                           result_name: str) -> None:
+    """ Decompress the single-stream .huff file <body>. Its decoder carries
+    its state from one byte to the next, so the work cannot be split into
+    jobs for the pool as it arrives: the body is saved and decoded on the
+    pool in one go.
+    """
+    loop = asyncio.get_running_loop()
+    save_path = CONFIG['SAVE_PATH']
+    os.makedirs(save_path, exist_ok=True)
+    work_dir = tempfile.mkdtemp(dir=save_path)
+    try:
+        src = os.path.join(work_dir, filename)
+        dst = os.path.join(work_dir, result_name)
+        await save_body(body, src)
+        try:
+            await loop.run_in_executor(get_pool(), decompress_stream_file,
+                                       src, dst)
+        except (ValueError, IndexError) as e:
+            await send_response(send, 400, f'{e}\n'.encode())
+            return
+        await send_file(send, dst, result_name)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+async def stream(receive: Receive, send: Send, filename: str) -> None:
+    """ Compress the request body into a block file with a tree per block,
+    sending each frame as soon as its block is encoded, or decompress a .huff
+    body. The output is the same as blocks.compress_stream gives.
+    """
+    loop = asyncio.get_running_loop()
+    operation, result_name = _result_name(filename)
+    if operation == 'decompress':
+        body = BodyReader(receive)
+        await body.fill(2)
+        if body.peek(2) == bytes([0, blocks.VERSION_BLOCKS]):
+            await stream_decompress_blocks(body, send, result_name)
+        else:
+            await decompress_saved(body, send, filename, result_name)
+        return
+
+    block_size, pool = blocks.BLOCK_SIZE, get_pool()
+    await start_download(send, result_name)
+    await send({'type': 'http.response.body', 'more_body': True,
+                'body': blocks.block_header(0, block_size)})
+    buf, pending = bytearray(), deque()
+
+    async def send_frame() -> None:
+        await send({'type': 'http.response.body', 'more_body': True,
+                    'body': await pending.popleft()})
+
+    async for chunk in read_body(receive):
+        buf += chunk
+        while len(buf) >= block_size:
+            pending.append(loop.run_in_executor(
+                pool, blocks.encode_block, bytes(buf[:block_size])))
+            del buf[:block_size]
+            if len(pending) > CONFIG['STREAM_BLOCKS_AHEAD']:
+                await send_frame()
+    if buf:
+        pending.append(loop.run_in_executor(pool, blocks.encode_block,
+                                            bytes(buf)))
+    while pending:
+        await send_frame()
+    await send({'type': 'http.response.body',
+                'body': bytes([blocks.BLOCK_END])})
+
+
+async def metrics(send: Send) -> None:
+    """ Send the cache counters in the Prometheus text format."""
+    await send_response(send, 200, get_result_cache().metrics().encode(),
+                        'text/plain; version=0.0.4')
+
+
+async def lifespan(receive: Receive, send: Send) -> None:
+    """ Answer the server's startup and shutdown messages, stopping the pool
+    on shutdown.
+    """
+    global _pool
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            if _pool is not None:
+                _pool.shutdown()
+                _pool = None
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope: dict[str, Any], receive: Receive, send: Send) -> None:
+    """ The ASGI application."""
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+    method, path = scope['method'], scope['path']
+    route, _, filename = path.lstrip('/').partition('/')
+    filename = secure_filename(filename)
+    try:
+        if method == 'POST' and route == 'upload' and filename:
+            await upload(receive, send, filename)
+        elif method == 'POST' and route == 'stream' and filename:
+            await stream(receive, send, filename)
+        elif method == 'GET' and path == '/metrics':
+            await metrics(send)
+        else:
+            await send_response(send, 404, b'Not found!\n')
+    except ClientDisconnected:
+        logger.info('%s %s: client disconnected', method, path)
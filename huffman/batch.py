@@ -0,0 +1,248 @@
+"""
+Compress or decompress many files at once.
+
+Paths may be files, directories (searched recursively) or glob patterns.
+Files are handed to a pool of worker processes largest first, so one big
+file does not hold up the end of the batch: the largest ones one at a time,
+and the small files that follow in chunks. With --dictionary, one
+dictionary is trained on a sample of the batch (see dictionary.py) and
+every file is coded with it, which saves a header per file on batches of
+small similar files. With --checksum, files are written as block files
+with a CRC-32 per block (see blocks.py).
+
+verify checks .huff files without writing anything, e.g. in a nightly
+integrity sweep: block files with checksums are checked against them, other
+files are decoded in memory. A single block file is checked block by block
+on all the workers.
+
+Run with:  python batch.py compress DIR_OR_GLOB [...] [--workers N]
+           python batch.py decompress DIR_OR_GLOB [...] [--dictionary DIR]
+           python batch.py verify DIR_OR_GLOB [...] [--dictionary DIR]
+"""
+from __future__ import annotations
+
+import argparse
+import glob
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Iterator, Optional
+
+from blocks import (VERSION_BLOCKS, compress_file_blocks,
+                    decompress_file_blocks, verify_file_blocks)
+from compress2 import *
+from dictionary import (VERSION_DICTIONARY, compress_file_dictionary,
+                        decompress_file_dictionary, dictionary_id,
+                        save_dictionary, train_dictionary)
+from wide import VERSION_WIDE, decompress_file_wide
+
+SUFFIX = ".huff"
+
+# files used to train a shared dictionary, spread over the batch
+DICTIONARY_SAMPLE = 1000
+
+
+def find_files(paths: Iterable[str], decompress: bool) -> list[str]:
+    """ Return the files named by <paths>, which may be files, directories
+    or glob patterns. Only .huff files are decompressed, and .huff files are
+    not compressed again.
+    """
+    found = {}
+    for path in paths:
+        if os.path.isdir(path):
+            candidates = (os.path.join(root, name)
+                          for root, _, names in os.walk(path)
+                          for name in names)
+        elif os.path.exists(path):
+            candidates = [path]
+        else:
+            candidates = glob.iglob(path, recursive=True)
+        for candidate in candidates:
+            if os.path.isfile(candidate) \
+                    and candidate.endswith(SUFFIX) == decompress:
+                found[candidate] = None
+    return list(found)
+
+
+def output_path(path: str, decompress: bool) -> str:
+    """ Return where the result for <path> is written.
+
+    >>> output_path('logs/a.txt', False), output_path('logs/a.txt.huff', True)
+    ('logs/a.txt.huff', 'logs/a.txt')
+    """
+    return path[:-len(SUFFIX)] if decompress else path + SUFFIX
+
+
+def decompress_any(in_file: str, out_file: str,
+                   dictionaries: Optional[str] = None) -> None:
+    """ Decompress <in_file> whatever format it was written in. Files coded
+    with a dictionary need the dictionary directory <dictionaries>.
+    """
+    with open(in_file, "rb") as f:
+        magic = f.read(2)
+    version = magic[1] if len(magic) == 2 and magic[0] == 0 else None
+    if version == VERSION_BLOCKS:
+        decompress_file_blocks(in_file, out_file, workers=1)
+    elif version == VERSION_WIDE:
+        decompress_file_wide(in_file, out_file)
+    elif version == VERSION_DICTIONARY:
+        if dictionaries is None:
+            raise ValueError("coded with a dictionary, use --dictionary")
+        decompress_file_dictionary(in_file, out_file, dictionaries)
+    else:
+        decompress_file(in_file, out_file)
+
+
+def verify_any(in_file: str, dictionaries: Optional[str] = None,
+               workers: int = 1) -> None:
+    """ Check <in_file> whatever format it was written in, without writing
+    any output. Block files are checked on <workers> processes; other files
+    are decoded into os.devnull. Raise ValueError if <in_file> is damaged.
+    """
+    with open(in_file, "rb") as f:
+        magic = f.read(2)
+    if magic == bytes([0, VERSION_BLOCKS]):
+        verify_file_blocks(in_file, workers)
+    else:
+        decompress_any(in_file, os.devnull, dictionaries)
+
+
+def _process_file(path: str, decompress: bool, dictionary: Optional[str],
+                  dictionaries: Optional[str], verify: bool, checksum: bool,
+                  block_workers: int) -> tuple[str, int, int, Optional[str]]:
+    """ Compress, decompress or verify <path> and return (path, bytes in,
+    bytes out, error message or None).
+    """
+    out, size = output_path(path, decompress), 0
+    try:
+        # the size is taken first, so the error branch does not stat a file
+        # that may have gone
+        size = os.path.getsize(path)
+        if verify:
+            verify_any(path, dictionaries, block_workers)
+            return path, size, 0, None
+        if decompress:
+            decompress_any(path, out, dictionaries)
+        elif dictionary is not None:
+            compress_file_dictionary(path, out, dictionary)
+        elif checksum:
+            compress_file_blocks(path, out, workers=1, checksum=True)
+        else:
+            compress_file(path, out)
+        return path, size, os.path.getsize(out), None
+    except (OSError, ValueError, IndexError) as e:
+        return path, size, 0, f"{type(e).__name__}: {e}"
+
+
+def run_batch(files: list[str], decompress: bool = False,
+              workers: Optional[int] = None,
+              dictionary: Optional[str] = None,
+              dictionaries: Optional[str] = None,
+              verify: bool = False, checksum: bool = False) \
+        -> Iterator[tuple[str, int, int, Optional[str]]]:
+    """ Yield the result of _process_file for each of <files>, on <workers>
+    processes (one per CPU by default), largest files first.
+    """
+    files = sorted(files, key=os.path.getsize, reverse=True)
+    workers = workers or os.cpu_count() or 1
+    # a single block file is verified on all the workers, block by block
+    block_workers = workers if len(files) == 1 else 1
+    jobs = [(path, decompress, dictionary, dictionaries, verify, checksum,
+             block_workers) for path in files]
+    if workers == 1 or len(jobs) < 2:
+        for job in jobs:
+            yield _process_file(*job)
+        return
+    head, tail, chunksize = split_jobs(jobs, workers)
+    with ProcessPoolExecutor(workers) as pool:
+        # map submits all of its jobs at once, so the tail is queued behind
+        # the head before any result is waited for
+        results = [pool.map(_process_file, *zip(*part), chunksize=size)
+                   for part, size in ((head, 1), (tail, chunksize)) if part]
+        for part in results:
+            yield from part
+
+
+def split_jobs(jobs: list, workers: int) -> tuple[list, list, int]:
+    """ Split <jobs>, sorted largest first, into the head that is sent to the
+    <workers> one job at a time and the tail that is sent in chunks, and
+    return both with the tail's chunk size. A chunk of the largest files
+    would keep them all on one worker, so only the small files are chunked,
+    a few chunks per worker to not pay a round trip per small file.
+
+    >>> head, tail, chunksize = split_jobs(list(range(1000)), 4)
+    >>> len(head), tail[0], chunksize
+    (32, 32, 30)
+    """
+    split = workers * 8
+    head, tail = jobs[:split], jobs[split:]
+    return head, tail, max(1, min(64, len(tail) // (workers * 8)))
+
+
+def train_batch_dictionary(files: list[str], directory: str,
+                           sample: int = DICTIONARY_SAMPLE) -> str:
+    """ Train a dictionary on up to <sample> of <files>, evenly spread over
+    them by size, save it in <directory> and return its path. Dictionaries
+    are named by id, so the ones earlier batches need are kept.
+    """
+    files = sorted(files, key=os.path.getsize)
+    step = max(1, len(files) // sample)
+    lengths = train_dictionary(files[::step][:sample])
+    return save_dictionary(lengths, directory,
+                           f"batch-{dictionary_id(lengths):08x}")
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('mode', choices=['compress', 'decompress', 'verify'])
+    parser.add_argument('paths', nargs='+',
+                        help='files, directories or glob patterns')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='worker processes, default one per CPU')
+    parser.add_argument('--dictionary', metavar='DIR',
+                        help='directory of shared dictionaries; when '
+                             'compressing, train one on the batch and use it')
+    parser.add_argument('--checksum', action='store_true',
+                        help='compress into block files with a CRC-32 per '
+                             'block')
+    args = parser.parse_args(argv)
+    verify = args.mode == 'verify'
+    decompress = args.mode == 'decompress' or verify
+
+    start = time.perf_counter()
+    files = find_files(args.paths, decompress)
+    dictionary = None
+    if args.dictionary and not decompress and not args.checksum and files:
+        dictionary = train_batch_dictionary(files, args.dictionary)
+        print(f'dictionary {dictionary}')
+
+    count = failed = total_in = total_out = 0
+    for path, size_in, size_out, error in run_batch(
+            files, decompress, args.workers, dictionary, args.dictionary,
+            verify, args.checksum):
+        if error is not None:
+            failed += 1
+            print(f'{path}: {error}', file=sys.stderr)
+            continue
+        count += 1
+        total_in += size_in
+        total_out += size_out
+    seconds = time.perf_counter() - start
+
+    if verify:
+        print(f'verified {count} files ({failed} failed) in {seconds:.2f} s: '
+              f'{total_in / (1 << 20) / max(seconds, 1e-9):.2f} MB/s, '
+              f'{count / max(seconds, 1e-9):.0f} files/s')
+        return 1 if failed else 0
+    original = total_out if decompress else total_in
+    compressed = total_in if decompress else total_out
+    print(f'{args.mode}ed {count} files ({failed} failed) in {seconds:.2f} s: '
+          f'{original / (1 << 20) / max(seconds, 1e-9):.2f} MB/s, '
+          f'{count / max(seconds, 1e-9):.0f} files/s, ratio '
+          f'{compressed / original if original else 0:.3f}')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,420 @@
+"""
+Benchmarks for the Huffman compressor in compress2.py.
+
+Run with:  python bench_huffman.py [--sizes 1 100 1024]
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import random
+import tempfile
+import time
+import zlib
+from typing import Callable
+
+from blocks import (compress_file_blocks, compress_stream,
+                    decompress_file_blocks)
+from compress2 import *
+from dictionary import (compress_file_dictionary,
+                        decompress_file_dictionary, save_dictionary,
+                        train_dictionary)
+from flat_tree import FlatTree
+from wide import (compress_file_wide, decompress_file_wide,
+                  tree_to_bytes_wide)
+
+
+MB = 1 << 20
+
+
+def make_corpus(size: int, seed: int = 148) -> bytes:
+    """ Return <size> bytes of English-like text, so the tree has a realistic
+    mix of short and long codes. Corpora above 1 MB repeat a 1 MB block.
+    """
+    rng = random.Random(seed)
+    alphabet = b'etaoin shrdlucmfwypvbgkjqxz' * 8 + bytes(range(256))
+    block = bytes(rng.choices(alphabet, k=min(size, MB)))
+    return (block * (size // len(block) + 1))[:size] if block else block
+
+
+def make_text_corpus(size: int, seed: int = 148) -> bytes:
+    """ Return <size> bytes of words from a small vocabulary, where pairs of
+    bytes are much more predictable than single bytes.
+    """
+    rng = random.Random(seed)
+    letters = b'etaoinshrdlucmfwypvbgk'
+    words = [bytes(rng.choices(letters, k=rng.randint(2, 9)))
+             for _ in range(500)]
+    block = b' '.join(rng.choices(words, k=min(size, MB) // 5))[:MB]
+    return (block * (size // len(block) + 1))[:size]
+
+
+def best_time(func: Callable[[], object], repeat: int = 3) -> float:
+    """ Return the fastest of <repeat> runs of <func>, in seconds."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def bench_frequency(size: int = MB) -> None:
+    """ Compare the per-byte loop in build_frequency_dict with
+    build_frequency_dict_fast (numpy if installed, else collections.Counter).
+    """
+    text = make_corpus(size)
+    loop = best_time(lambda: build_frequency_dict(text))
+    fast = best_time(lambda: build_frequency_dict_fast(text))
+    backend = 'numpy' if np is not None else 'Counter'
+    mb = size / MB
+    print(f'count {mb:.0f} MB: loop {mb / loop:.2f} MB/s, '
+          f'{backend} {mb / fast:.2f} MB/s ({loop / fast:.1f}x)')
+
+
+def bench_build_tree(num_symbols: int = 256) -> None:
+    """ Compare build_huffman_tree, which re-sorts its list after every merge,
+    with the heap-based builder on an alphabet of <num_symbols> symbols.
+    The sorting builder is skipped above 4096 symbols.
+    """
+    rng = random.Random(num_symbols)
+    freq = {sym: rng.randint(1, 10000) for sym in range(num_symbols)}
+    heap = best_time(lambda: build_huffman_tree_heap(freq))
+    line = f'build tree {num_symbols} symbols: heap {heap * 1000:.2f} ms'
+    if num_symbols <= 4096:
+        sort = best_time(lambda: build_huffman_tree(freq))
+        line += f', sort {sort * 1000:.2f} ms ({sort / heap:.1f}x)'
+    print(line)
+
+
+def _improve_tree_pop0(tree: HuffmanTree, freq_dict: dict[int, int]) -> None:
+    """ improve_tree as it was, with a list as the queue, for comparison."""
+    sorted_freq_dict = sorted([(freq_dict[key], key) for key in freq_dict])
+    tree_list = [tree]
+    while tree_list:
+        subtree = tree_list.pop(0)
+        if subtree.is_leaf():
+            subtree.symbol = sorted_freq_dict.pop()[1]
+        if subtree.left is not None:
+            tree_list.append(subtree.left)
+        if subtree.right is not None:
+            tree_list.append(subtree.right)
+
+
+def bench_codes(num_symbols: int = 256) -> None:
+    """ Compare get_codes (string codes in dicts) with get_code_arrays, and
+    improve_tree with a list queue against the deque in level_order, on a
+    tree of <num_symbols> symbols.
+    """
+    rng = random.Random(num_symbols)
+    freq = {sym: rng.randint(1, 10000) for sym in range(num_symbols)}
+    tree = build_huffman_tree_heap(freq)
+    repeat = 5 if num_symbols <= 4096 else 3
+    strings = best_time(lambda: get_code_pairs(get_codes(tree)), repeat)
+    arrays = best_time(lambda: get_code_arrays(tree), repeat)
+    pop0 = best_time(lambda: _improve_tree_pop0(tree, freq), repeat)
+    queue = best_time(lambda: improve_tree(tree, freq), repeat)
+    print(f'codes {num_symbols} symbols: get_codes {strings * 1000:.2f} ms, '
+          f'get_code_arrays {arrays * 1000:.2f} ms '
+          f'({strings / arrays:.1f}x); improve_tree list {pop0 * 1000:.2f} '
+          f'ms, deque {queue * 1000:.2f} ms ({pop0 / queue:.1f}x)')
+
+
+def bench_decompress(size: int = MB) -> None:
+    """ Compare the bit-by-bit tree walker with the table-driven decoder."""
+    text = make_corpus(size)
+    tree = build_huffman_tree(build_frequency_dict(text))
+    compressed = compress_bytes(text, get_codes(tree))
+    assert decompress_bytes_table(tree, compressed, size) == text
+
+    walker = best_time(lambda: decompress_bytes(tree, compressed, size))
+    table = best_time(lambda: decompress_bytes_table(tree, compressed, size))
+    mb = size / MB
+    print(f'decompress {mb:.0f} MB: walker {mb / walker:.2f} MB/s, '
+          f'table {mb / table:.2f} MB/s ({walker / table:.1f}x)')
+
+
+def bench_compress(size: int = MB) -> None:
+    """ Compare the string-joining encoder with the integer bit-packing
+    encoder. The string encoder needs about 9 bytes of memory per input byte,
+    so it is skipped for inputs above 128 MB.
+    """
+    text = make_corpus(size)
+    codes = get_codes(build_huffman_tree(build_frequency_dict(text)))
+    mb = size / MB
+    repeat = 3 if size <= 100 * MB else 1
+
+    packed = best_time(lambda: compress_bytes_packed(text, codes), repeat)
+    line = f'compress {mb:.0f} MB: packed {mb / packed:.2f} MB/s'
+    if size <= 128 * MB:
+        joined = best_time(lambda: compress_bytes(text, codes), repeat)
+        line += f', string {mb / joined:.2f} MB/s ({joined / packed:.1f}x)'
+    print(line)
+
+
+def bench_blocks(size: int, workers: list[int]) -> None:
+    """ Time the block container on 1, 2, 4, ... worker processes."""
+    with tempfile.TemporaryDirectory() as tmp:
+        src, huff, out = (os.path.join(tmp, name)
+                          for name in ('src', 'src.huff', 'out'))
+        with open(src, 'wb') as f:
+            f.write(make_corpus(size))
+        mb = size / MB
+        for count in workers:
+            comp = best_time(lambda: compress_file_blocks(
+                src, huff, workers=count), 1)
+            dec = best_time(lambda: decompress_file_blocks(
+                huff, out, workers=count), 1)
+            print(f'blocks {mb:.0f} MB, {count} workers: compress '
+                  f'{mb / comp:.2f} MB/s, decompress {mb / dec:.2f} MB/s')
+
+
+def bench_wide(size: int = MB) -> None:
+    """ Compare compression ratio and speed of 16-bit symbols against bytes
+    on word-based text.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        src, huff, out = (os.path.join(tmp, name)
+                          for name in ('src', 'src.huff', 'out'))
+        with open(src, 'wb') as f:
+            f.write(make_text_corpus(size))
+        mb = size / MB
+        for name, comp, decomp in (('byte', compress_file, decompress_file),
+                                   ('wide', compress_file_wide,
+                                    decompress_file_wide)):
+            comp_time = best_time(lambda: comp(src, huff), 1)
+            decomp_time = best_time(lambda: decomp(huff, out), 1)
+            ratio = os.path.getsize(huff) / size
+            print(f'{name} symbols {mb:.0f} MB: ratio {ratio:.3f}, compress '
+                  f'{mb / comp_time:.2f} MB/s, decompress '
+                  f'{mb / decomp_time:.2f} MB/s')
+
+
+def bench_flat_tree(repeat: int = 200) -> None:
+    """ Compare writing and reading a 256-symbol tree header with linked
+    HuffmanTree nodes and with FlatTree arrays.
+    """
+    rng = random.Random(256)
+    tree = build_huffman_tree_heap({sym: rng.randint(1, 10000)
+                                    for sym in range(256)})
+
+    def write_linked() -> None:
+        for _ in range(repeat):
+            get_code_pairs(get_codes(tree))
+            number_nodes(tree)
+            tree_to_bytes(tree)
+
+    def write_flat() -> None:
+        for _ in range(repeat):
+            flat = FlatTree.from_tree(tree)
+            flat.code_pairs()
+            flat.tree_to_bytes()
+
+    number_nodes(tree)
+    buf = tree_to_bytes(tree)
+
+    def read_linked() -> None:
+        for _ in range(repeat):
+            flatten_tree(generate_tree_general(bytes_to_nodes(buf),
+                                               len(buf) // 4 - 1))
+
+    def read_flat() -> None:
+        for _ in range(repeat):
+            FlatTree.from_postorder(buf)
+
+    for name, linked, flat in (('write header', write_linked, write_flat),
+                               ('read header', read_linked, read_flat)):
+        linked_time = best_time(linked) / repeat
+        flat_time = best_time(flat) / repeat
+        print(f'{name} 256 symbols: HuffmanTree {linked_time * 1e6:.0f} us, '
+              f'FlatTree {flat_time * 1e6:.0f} us '
+              f'({linked_time / flat_time:.1f}x)')
+
+
+def bench_read_tree(repeat: int = 50) -> None:
+    """ Compare the ways of reading a post-order node table: the recursive
+    generate_tree_general and generate_tree_postorder (then flattened), and
+    the single-pass FlatTree.from_postorder. Byte trees have at most 255
+    internal nodes; the 16-bit tables are only read by from_postorder,
+    since the recursive readers would hit the recursion limit on deep trees.
+    """
+    rng = random.Random(255)
+    # random frequencies give a bushy tree, powers of two a 255-deep chain
+    for shape, freq in (('bushy', {sym: rng.randint(1, 10000)
+                                   for sym in range(256)}),
+                        ('deep', {sym: 1 << sym for sym in range(256)})):
+        tree = build_huffman_tree_heap(freq)
+        number_nodes(tree)
+        buf = tree_to_bytes(tree)
+        nodes = len(buf) // 4
+        readers = (
+            ('general', lambda: flatten_tree(generate_tree_general(
+                bytes_to_nodes(buf), nodes - 1))),
+            ('postorder', lambda: flatten_tree(generate_tree_postorder(
+                bytes_to_nodes(buf), nodes - 1))),
+            ('from_postorder', lambda: FlatTree.from_postorder(buf)))
+        line = f'read {shape} tree {nodes} nodes:'
+        for name, reader in readers:
+            line += f' {name} {best_time(reader, repeat) * 1e6:.0f} us,'
+        print(line.rstrip(','))
+
+    for num_symbols in (4096, 65536):
+        freq = {sym: rng.randint(1, 10000) for sym in range(num_symbols)}
+        wide_tree = build_huffman_tree_heap(freq)
+        number_nodes(wide_tree)
+        wide_buf = tree_to_bytes_wide(wide_tree)
+        read = best_time(lambda: FlatTree.from_postorder(wide_buf, 2), 3)
+        print(f'read 16-bit tree {num_symbols - 1} nodes: from_postorder '
+              f'{read * 1000:.2f} ms')
+
+
+def make_mixed_corpus(size: int, seed: int = 148) -> bytes:
+    """ Return <size> bytes that switch between text, words, little-endian
+    integers and random bytes every 512 KB, so the byte distribution
+    changes across the file.
+    """
+    rng = random.Random(seed)
+    part = MB // 2
+    parts = [make_corpus(part, seed), make_text_corpus(part, seed),
+             b''.join(rng.randrange(1000).to_bytes(4, 'little')
+                      for _ in range(part // 4)),
+             rng.randbytes(part)]
+    return b''.join(parts[i % len(parts)]
+                    for i in range(size // part + 1))[:size]
+
+
+def bench_adaptive(size: int = 4 * MB,
+                   block_sizes: tuple[int, ...] = (1 << 18, 1 << 12)) -> None:
+    """ Compare one tree for the whole file with per-block and adaptive
+    trees on a file whose byte distribution changes every 512 KB. With small
+    blocks the code lengths of every block add up, and adaptive mode only
+    stores them where they pay off.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        src, huff = os.path.join(tmp, 'src'), os.path.join(tmp, 'src.huff')
+        with open(src, 'wb') as f:
+            f.write(make_mixed_corpus(size))
+        mb = size / MB
+        comp_time = best_time(lambda: compress_file(src, huff), 1)
+        print(f'global tree, mixed {mb:.0f} MB: ratio '
+              f'{os.path.getsize(huff) / size:.4f}, '
+              f'compress {mb / comp_time:.2f} MB/s')
+
+        for block_size in block_sizes:
+            def stream(src: str, dst: str) -> None:
+                with open(src, 'rb') as f, open(dst, 'wb') as g:
+                    for piece in compress_stream(read_chunks(f, CHUNK_SIZE),
+                                                 block_size, adaptive=True):
+                        g.write(piece)
+
+            for name, comp in (
+                    ('shared tree', lambda src, dst: compress_file_blocks(
+                        src, dst, block_size, workers=1)),
+                    ('per-block trees', lambda src, dst: compress_file_blocks(
+                        src, dst, block_size, per_block_trees=True,
+                        workers=1)),
+                    ('adaptive', lambda src, dst: compress_file_blocks(
+                        src, dst, block_size, workers=1, adaptive=True)),
+                    ('adaptive stream', stream)):
+                comp_time = best_time(lambda: comp(src, huff), 1)
+                ratio = os.path.getsize(huff) / size
+                print(f'{name}, {block_size // 1024} KB blocks, mixed '
+                      f'{mb:.0f} MB: ratio {ratio:.4f}, '
+                      f'compress {mb / comp_time:.2f} MB/s')
+
+
+def make_log_lines(count: int, seed: int = 148) -> list[bytes]:
+    """ Return <count> JSON log lines with the same few fields."""
+    rng = random.Random(seed)
+    levels = ['debug', 'info', 'warning', 'error']
+    return [(f'{{"ts": {1700000000 + i}, "level": "{rng.choice(levels)}", '
+             f'"user": {rng.randint(1, 9999)}, "msg": "request took '
+             f'{rng.randint(1, 999)} ms"}}\n').encode() for i in range(count)]
+
+
+def bench_dictionary(num_files: int = 200, file_size: int = 1024) -> None:
+    """ Compare compress_file with a dictionary trained on similar files, on
+    <num_files> small JSON log files of about <file_size> bytes.
+    """
+    lines = make_log_lines(num_files * file_size // 90 * 2)
+    with tempfile.TemporaryDirectory() as tmp:
+        files = []
+        for i in range(num_files * 2):
+            files.append(os.path.join(tmp, f'log{i}'))
+            with open(files[-1], 'wb') as f:
+                f.write(b''.join(lines[i::num_files * 2]))
+        # train on half of the files, compress the other half
+        train, test = files[:num_files], files[num_files:]
+        dictionary = save_dictionary(train_dictionary(train), tmp, 'logs')
+        original = sum(os.path.getsize(path) for path in test)
+        huff, out = os.path.join(tmp, 'out.huff'), os.path.join(tmp, 'out')
+
+        def run(comp, decomp) -> tuple[float, float, int]:
+            comp_time = decomp_time = 0.0
+            total = 0
+            for path in test:
+                comp_time += best_time(lambda: comp(path, huff), 1)
+                total += os.path.getsize(huff)
+                decomp_time += best_time(lambda: decomp(huff, out), 1)
+            return comp_time, decomp_time, total
+
+        for name, comp, decomp in (
+                ('per file', compress_file, decompress_file),
+                ('dictionary',
+                 lambda src, dst: compress_file_dictionary(src, dst,
+                                                           dictionary),
+                 lambda src, dst: decompress_file_dictionary(src, dst, tmp))):
+            comp_time, decomp_time, total = run(comp, decomp)
+            print(f'{name} trees, {num_files} x {original // num_files} B: '
+                  f'ratio {total / original:.3f}, compress '
+                  f'{num_files / comp_time:.0f} files/s, decompress '
+                  f'{num_files / decomp_time:.0f} files/s')
+
+
+def bench_stored(size: int = 4 * MB) -> None:
+    """ Compare coding already compressed input (zlib output of the text
+    corpus) with storing it, for compress_file and decompress_file.
+    """
+    text = bytearray()
+    while len(text) < size:
+        text += zlib.compress(make_text_corpus(MB, len(text)), 9)
+    mb = size / MB
+    with tempfile.TemporaryDirectory() as tmp:
+        src, huff, out = (os.path.join(tmp, name)
+                          for name in ('src', 'src.huff', 'out'))
+        with open(src, 'wb') as f:
+            f.write(text[:size])
+        lines = []
+        for name, allow_stored in (('coded', False), ('stored', True)):
+            comp = best_time(lambda: compress_file(
+                src, huff, allow_stored=allow_stored))
+            decomp = best_time(lambda: decompress_file(huff, out))
+            lines.append(f'{name}: ratio {os.path.getsize(huff) / size:.4f}, '
+                         f'compress {mb / comp:.2f} MB/s, '
+                         f'decompress {mb / decomp:.2f} MB/s')
+    print(f'already compressed {mb:.0f} MB: ' + '; '.join(lines))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1],
+                        help='input sizes in MB, e.g. --sizes 1 100 1024')
+    parser.add_argument('--workers', type=int, nargs='+',
+                        default=[1, os.cpu_count() or 1],
+                        help='worker counts for the block container')
+    args = parser.parse_args()
+    for num_symbols in (256, 4096, 65536):
+        bench_build_tree(num_symbols)
+    for num_symbols in (256, 65536):
+        bench_codes(num_symbols)
+    for mb_size in args.sizes:
+        bench_frequency(mb_size * MB)
+        bench_compress(mb_size * MB)
+    bench_decompress()
+    bench_flat_tree()
+    bench_read_tree()
+    bench_blocks(8 * MB, args.workers)
+    bench_wide()
+    bench_adaptive()
+    bench_dictionary()
+    bench_stored()
@@ -0,0 +1,282 @@
+"""
+Benchmark suite for the Huffman compressor with a JSON baseline.
+
+Every benchmark runs on synthetic corpora (uniform, skewed, text and already
+compressed bytes) at each size, and the throughput is saved to a baseline
+file. Later runs are compared against it, and the run fails (exit status 1)
+if any result is more than --tolerance slower than the baseline.
+
+Run with:  python bench_suite.py [--sizes 1K 1M 1G] [--update]
+
+The first run, or a run with --update, writes the baseline instead.
+Baselines only make sense on the machine they were made on.
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import zlib
+from typing import Callable, Optional
+
+from bench_huffman import MB, make_text_corpus
+from compress2 import *
+
+KB = 1 << 10
+GB = 1 << 30
+DEFAULT_SIZES = ['1K', '64K', '1M']
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'bench_baseline.json')
+
+
+def parse_size(text: str) -> int:
+    """ Return the number of bytes in a size like 512, 64K, 1M or 1G.
+
+    >>> parse_size('64K'), parse_size('1G'), parse_size('100')
+    (65536, 1073741824, 100)
+    """
+    units = {'K': KB, 'M': MB, 'G': GB}
+    if text[-1:].upper() in units:
+        return int(text[:-1]) * units[text[-1].upper()]
+    return int(text)
+
+
+def format_size(size: int) -> str:
+    """ Return <size> in the form parse_size reads.
+
+    >>> format_size(65536), format_size(1 << 30), format_size(100)
+    ('64K', '1G', '100')
+    """
+    for unit, scale in (('G', GB), ('M', MB), ('K', KB)):
+        if size >= scale and size % scale == 0:
+            return f'{size // scale}{unit}'
+    return str(size)
+
+
+def _tile(block: bytes, size: int) -> bytes:
+    """ Return <block> repeated up to exactly <size> bytes."""
+    return (block * (size // len(block) + 1))[:size]
+
+
+def make_uniform_corpus(size: int, seed: int = 148) -> bytes:
+    """ Return <size> random bytes, where Huffman codes cannot help."""
+    return _tile(random.Random(seed).randbytes(min(size, MB)), size)
+
+
+def make_skewed_corpus(size: int, seed: int = 148) -> bytes:
+    """ Return <size> bytes where each byte value is 3/4 as likely as the one
+    before it, so a few symbols get very short codes and the rest long ones.
+    """
+    rng = random.Random(seed)
+    weights = [0.75 ** sym for sym in range(256)]
+    return _tile(bytes(rng.choices(range(256), weights, k=min(size, MB))),
+                 size)
+
+
+def make_compressed_corpus(size: int, seed: int = 148) -> bytes:
+    """ Return <size> bytes of zlib output, which is already close to random.
+    """
+    block = bytearray()
+    while len(block) < min(size, MB):
+        block += zlib.compress(make_text_corpus(MB, seed + len(block)), 9)
+    return _tile(bytes(block), size)
+
+
+CORPORA = {
+    'uniform': make_uniform_corpus,
+    'skewed': make_skewed_corpus,
+    'text': make_text_corpus,
+    'compressed': make_compressed_corpus,
+}
+
+Setup = Callable[[bytes, str], Callable[[], object]]
+
+
+def _setup_frequency(text: bytes, tmp: str) -> Callable[[], object]:
+    return lambda: build_frequency_dict(text)
+
+
+def _setup_build_tree(text: bytes, tmp: str) -> Callable[[], object]:
+    freq = build_frequency_dict_fast(text)
+    return lambda: build_huffman_tree(freq)
+
+
+def _setup_get_codes(text: bytes, tmp: str) -> Callable[[], object]:
+    tree = build_huffman_tree(build_frequency_dict_fast(text))
+    return lambda: get_codes(tree)
+
+
+def _setup_compress_bytes(text: bytes, tmp: str) -> Callable[[], object]:
+    codes = get_codes(build_huffman_tree(build_frequency_dict_fast(text)))
+    return lambda: compress_bytes(text, codes)
+
+
+def _setup_decompress_bytes(text: bytes, tmp: str) -> Callable[[], object]:
+    tree = build_huffman_tree(build_frequency_dict_fast(text))
+    compressed = compress_bytes_packed(text, get_codes(tree))
+    return lambda: decompress_bytes(tree, compressed, len(text))
+
+
+def _setup_compress_file(text: bytes, tmp: str) -> Callable[[], object]:
+    src, huff = os.path.join(tmp, 'src'), os.path.join(tmp, 'src.huff')
+    with open(src, 'wb') as f:
+        f.write(text)
+    return lambda: compress_file(src, huff)
+
+
+def _setup_decompress_file(text: bytes, tmp: str) -> Callable[[], object]:
+    src, huff, out = (os.path.join(tmp, name)
+                      for name in ('src', 'src.huff', 'out'))
+    with open(src, 'wb') as f:
+        f.write(text)
+    compress_file(src, huff)
+    return lambda: decompress_file(huff, out)
+
+
+# name: (setup, largest input size or None, True if the result is in MB/s
+# of input rather than calls per second). The pure Python reference
+# versions are skipped above their largest size.
+BENCHMARKS: dict[str, tuple[Setup, Optional[int], bool]] = {
+    'build_frequency_dict': (_setup_frequency, 64 * MB, True),
+    'build_huffman_tree': (_setup_build_tree, None, False),
+    'get_codes': (_setup_get_codes, None, False),
+    'compress_bytes': (_setup_compress_bytes, 64 * MB, True),
+    'decompress_bytes': (_setup_decompress_bytes, 4 * MB, True),
+    'compress_file': (_setup_compress_file, None, True),
+    'decompress_file': (_setup_decompress_file, None, True),
+}
+
+
+def measure(func: Callable[[], object], min_time: float = 0.3,
+            max_repeat: int = 7) -> float:
+    """ Return the fastest time of one call to <func>, in seconds. Fast calls
+    are timed in batches of at least 20 ms, and batches are repeated until
+    <min_time> has passed, at most <max_repeat> times.
+    """
+    start = time.perf_counter()
+    func()
+    first = time.perf_counter() - start
+    number = max(1, int(0.02 / first)) if first > 0 else 1000
+    best, spent = first, first
+    for _ in range(max_repeat):
+        if spent >= min_time:
+            break
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter() - start
+        best, spent = min(best, elapsed / number), spent + elapsed
+    return best
+
+
+def run_benchmark(name: str, text: bytes) -> dict[str, object]:
+    """ Return the throughput of the benchmark <name> on <text>."""
+    setup, _, per_byte = BENCHMARKS[name]
+    with tempfile.TemporaryDirectory() as tmp:
+        seconds = measure(setup(text, tmp))
+    if per_byte:
+        return {'value': len(text) / MB / seconds, 'unit': 'MB/s'}
+    return {'value': 1 / seconds, 'unit': 'calls/s'}
+
+
+def run_suite(sizes: list[int], corpora: list[str],
+              benchmarks: list[str]) -> dict[str, dict[str, object]]:
+    """ Run each of <benchmarks> on each of <corpora> at each of <sizes> and
+    return the results by 'benchmark/corpus/size'.
+    """
+    results = {}
+    for size in sizes:
+        for corpus in corpora:
+            text = CORPORA[corpus](size)
+            for name in benchmarks:
+                max_size = BENCHMARKS[name][1]
+                if max_size is not None and size > max_size:
+                    continue
+                key = f'{name}/{corpus}/{format_size(size)}'
+                results[key] = run_benchmark(name, text)
+                print(f'{key}: {results[key]["value"]:.2f} '
+                      f'{results[key]["unit"]}', flush=True)
+    return results
+
+
+def compare(results: dict[str, dict[str, object]],
+            baseline: dict[str, dict[str, object]],
+            tolerance: float) -> list[str]:
+    """ Return a line for every result that is more than <tolerance> (a
+    fraction) slower than the same result in <baseline>.
+
+    >>> compare({'a': {'value': 70.0, 'unit': 'MB/s'}},
+    ...         {'a': {'value': 100.0, 'unit': 'MB/s'}}, 0.25)
+    ['a: 70.00 MB/s, baseline 100.00 MB/s (-30%)']
+    >>> compare({'a': {'value': 80.0, 'unit': 'MB/s'}},
+    ...         {'a': {'value': 100.0, 'unit': 'MB/s'}}, 0.25)
+    []
+    """
+    regressions = []
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        old, new = baseline[key]['value'], result['value']
+        if new < old * (1 - tolerance):
+            regressions.append(f'{key}: {new:.2f} {result["unit"]}, baseline '
+                               f'{old:.2f} {result["unit"]} '
+                               f'({(new - old) / old:+.0%})')
+    return regressions
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--sizes', nargs='+', default=DEFAULT_SIZES,
+                        help='input sizes from 1K to 1G, e.g. --sizes 1K 1M')
+    parser.add_argument('--corpora', nargs='+', default=list(CORPORA),
+                        choices=list(CORPORA))
+    parser.add_argument('--only', nargs='+', default=list(BENCHMARKS),
+                        choices=list(BENCHMARKS), metavar='BENCHMARK',
+                        help='benchmarks to run, default all')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE,
+                        help='baseline JSON file')
+    parser.add_argument('--update', action='store_true',
+                        help='save the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed slowdown as a fraction, default 0.25')
+    args = parser.parse_args(argv)
+
+    results = run_suite([parse_size(size) for size in args.sizes],
+                        args.corpora, args.only)
+    if args.update or not os.path.exists(args.baseline):
+        baseline = {'machine': platform.platform(),
+                    'python': platform.python_version(),
+                    'results': results}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                # keep results this run did not cover
+                baseline['results'] = {**json.load(f)['results'], **results}
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print(f'baseline saved to {args.baseline}')
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    for key in results:
+        if compare({key: results[key]}, baseline['results'], args.tolerance):
+            # measure again before failing, since one slow run can be noise
+            name, corpus, size = key.split('/')
+            result = run_benchmark(name, CORPORA[corpus](parse_size(size)))
+            if result['value'] > results[key]['value']:
+                results[key] = result
+    regressions = compare(results, baseline['results'], args.tolerance)
+    for line in regressions:
+        print(f'REGRESSION {line}')
+    print(f'{len(results)} results, {len(regressions)} regressions '
+          f'against {args.baseline}')
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,490 @@
+"""
+Block container for Huffman-compressed files.
+
+The input is cut into independent blocks, so blocks can be encoded and
+decoded by a pool of worker processes. A block file looks like
+
+    0, VERSION_BLOCKS, flags, block size (4 bytes)
+    code lengths shared by all blocks (only if flags has FLAG_SHARED_TREE)
+    CRC-32 of the header bytes before it (only if flags has FLAG_CHECKSUM)
+    one frame per block:
+        kind (1 byte), original size (4 bytes), compressed size (4 bytes),
+        compressed size bytes of payload
+    BLOCK_END (1 byte)
+
+Code lengths are stored with compress2.lengths_to_bytes and the codes are
+canonical. A BLOCK_SHARED payload is coded with the shared code lengths, a
+BLOCK_TREE payload starts with its own code lengths. Both kinds can appear in
+one file: in adaptive mode each block gets its own tree only when that saves
+more bits than its code lengths take. A BLOCK_STORED payload is the original
+bytes, for blocks that no code makes smaller (see compress2.VERSION_STORED).
+
+With FLAG_CHECKSUM, the last 4 bytes of every payload are the CRC-32 of the
+frame's kind, original size and the rest of its payload. A corrupt block is
+then caught before it is decoded, and verify_file_blocks checks a whole file
+without decoding anything.
+"""
+from __future__ import annotations
+
+import functools
+import io
+import os
+import zlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, BinaryIO, Callable, Iterable, Iterator, Optional
+
+from compress2 import *
+
+VERSION_BLOCKS = 2
+FLAG_SHARED_TREE = 1
+FLAG_CHECKSUM = 2
+
+BLOCK_SHARED = 0
+BLOCK_TREE = 1
+BLOCK_STORED = 2
+BLOCK_END = 255
+
+BLOCK_SIZE = 1 << 21
+
+# the longest header read_block_header accepts: magic, flags and block size,
+# shared lengths of up to 255 counts and 256 symbols, and a CRC-32
+MAX_HEADER_BYTES = 7 + 1 + 2 * 255 + 256 + 4
+# the header of a frame: kind, original size and compressed size
+FRAME_HEADER_BYTES = 9
+
+
+def _run_ordered(func: Callable[..., Any], jobs: Iterable[tuple],
+                 workers: Optional[int]) -> Iterator[Any]:
+    """ Yield func(*job) for each job in <jobs>, in order.
+    With more than one worker the calls run in a process pool, and at most
+    2 * workers results are held at once. <workers> defaults to the number
+    of CPUs.
+    """
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        for job in jobs:
+            yield func(*job)
+        return
+    with ProcessPoolExecutor(workers) as pool:
+        pending = deque()
+        for job in jobs:
+            if len(pending) == 2 * workers:
+                yield pending.popleft().result()
+            pending.append(pool.submit(func, *job))
+        while pending:
+            yield pending.popleft().result()
+
+
+def _read_block(path: str, offset: int, length: int) -> bytes:
+    """ Return <length> bytes of the file <path>, starting at <offset>."""
+    with open(path, "rb") as f:
+        f.seek(offset)
+        return f.read(length)
+
+
+@functools.lru_cache(maxsize=8)
+def _shared_pairs(shared: bytes) -> tuple[list[int], list[int]]:
+    """ Return the code pairs for the shared code lengths <shared>, once per
+    worker process.
+    """
+    return canonical_code_pairs(read_canonical_header(io.BytesIO(shared)))
+
+
+@functools.lru_cache(maxsize=8)
+def _shared_table(shared: bytes) -> tuple[list[bytes], list[int]]:
+    """ Return the decode table for the shared code lengths <shared>, once
+    per worker process.
+    """
+    lengths = read_canonical_header(io.BytesIO(shared))
+    return build_decode_table(*canonical_flat_tree(lengths))
+
+
+def _own_tree_is_smaller(freq: dict[int, int], lengths: dict[int, int],
+                         shared: bytes) -> bool:
+    """ Return True iff coding a block with frequencies <freq> with its own
+    code lengths <lengths>, stored in the frame, takes fewer bits than
+    coding it with the shared code lengths <shared>.
+    """
+    shared_lengths = _shared_pairs(shared)[1]
+    if not all(shared_lengths[sym] for sym in freq):
+        return True  # the shared tree has no code for some byte
+    own_bits = sum(freq[sym] * lengths[sym] for sym in freq)
+    shared_bits = sum(freq[sym] * shared_lengths[sym] for sym in freq)
+    return own_bits + 8 * len(lengths_to_bytes(lengths)) < shared_bits
+
+
+def encode_block(block: bytes, shared: Optional[bytes] = None,
+                 adaptive: bool = False, checksum: bool = False) -> bytes:
+    """ Return the frame for <block>, coded with the code lengths <shared>,
+    or with a tree of its own if <shared> is None. If <adaptive> is True,
+    the block gets its own tree whenever that makes the frame smaller.
+    Blocks that would not get smaller are stored as they are. If <checksum>
+    is True, the payload ends with a CRC-32.
+    """
+    freq = build_frequency_dict_fast(block)
+    if entropy(freq) >= STORED_ENTROPY:
+        return _frame(BLOCK_STORED, len(block), block, checksum)
+    lengths = None
+    if shared is None or adaptive:
+        lengths = code_lengths(build_huffman_tree_heap(freq))
+        if shared is not None and not _own_tree_is_smaller(freq, lengths,
+                                                           shared):
+            lengths = None
+    if lengths is not None:
+        kind, pairs = BLOCK_TREE, canonical_code_pairs(lengths)
+        payload = bytearray(lengths_to_bytes(lengths))
+    else:
+        kind, pairs, payload = BLOCK_SHARED, _shared_pairs(shared), bytearray()
+    acc, nbits = pack_codes(block, pairs, 0, 0, payload)
+    flush_bits(acc, nbits, payload)
+    if len(payload) >= len(block):
+        return _frame(BLOCK_STORED, len(block), block, checksum)
+    return _frame(kind, len(block), payload, checksum)
+
+
+def _frame_crc(kind: int, size: int, payload: bytes) -> int:
+    """ Return the CRC-32 of a frame's kind, original size and payload."""
+    return zlib.crc32(payload, zlib.crc32(bytes([kind]) + int32_to_bytes(size)))
+
+
+def _frame(kind: int, size: int, payload: bytes, checksum: bool) -> bytes:
+    """ Return a frame of type <kind> for <size> original bytes, with a
+    CRC-32 at the end of the payload if <checksum> is True.
+    """
+    if checksum:
+        payload = bytes(payload) + int32_to_bytes(_frame_crc(kind, size,
+                                                             payload))
+    return (bytes([kind]) + int32_to_bytes(size)
+            + int32_to_bytes(len(payload)) + payload)
+
+
+def check_frame(kind: int, payload: bytes, size: int,
+                shared: Optional[bytes] = None,
+                checksum: bool = False) -> memoryview:
+    """ Return the payload of a frame of type <kind> without its checksum,
+    after checking the checksum if <checksum> is True, and that the frame
+    can be decoded to <size> bytes with the shared code lengths <shared>.
+    Raise ValueError if it cannot.
+    """
+    payload = memoryview(payload)
+    if checksum:
+        if len(payload) < 4:
+            raise ValueError("the frame has no checksum")
+        payload, crc = payload[:-4], bytes_to_int(payload[-4:])
+        if crc != _frame_crc(kind, size, payload):
+            raise ValueError("the frame does not match its checksum")
+    if kind == BLOCK_STORED:
+        if len(payload) != size:
+            raise ValueError(f"{len(payload)} bytes stored instead of {size}")
+    elif kind != BLOCK_TREE and not (kind == BLOCK_SHARED
+                                     and shared is not None):
+        raise ValueError(f"unexpected block kind {kind}")
+    return payload
+
+
+def decode_block(kind: int, payload: bytes, size: int,
+                 shared: Optional[bytes] = None,
+                 checksum: bool = False) -> bytes:
+    """ Return the <size> original bytes of a frame of type <kind> with
+    payload <payload>. <shared> is the file's shared code lengths, if any,
+    and <checksum> is True if the file has FLAG_CHECKSUM. Raise ValueError
+    if the frame fails check_frame or decodes to too few bytes.
+    """
+    payload = check_frame(kind, payload, size, shared, checksum)
+    if kind == BLOCK_STORED:
+        return bytes(payload)
+    if kind == BLOCK_TREE:
+        f = io.BytesIO(payload)
+        table = build_decode_table(*canonical_flat_tree(
+            read_canonical_header(f)))
+        payload = payload[f.tell():]
+    else:
+        table = _shared_table(shared)
+    return decode_all(table, payload, size)
+
+
+def is_block_file(path: str) -> bool:
+    """ Return True iff <path> is a block container file."""
+    with open(path, "rb") as f:
+        return f.read(2) == bytes([0, VERSION_BLOCKS])
+
+
+def block_header(flags: int, block_size: int,
+                 shared: Optional[bytes] = None) -> bytes:
+    """ Return the header of a block file with <flags>, <block_size> and the
+    shared code lengths <shared>, ending with its CRC-32 if <flags> has
+    FLAG_CHECKSUM.
+    """
+    header = (bytes([0, VERSION_BLOCKS, flags]) + int32_to_bytes(block_size)
+              + (shared or b""))
+    if flags & FLAG_CHECKSUM:
+        header += int32_to_bytes(zlib.crc32(header))
+    return header
+
+
+def read_block_header(f: BinaryIO) -> tuple[int, int, Optional[bytes]]:
+    """ Read the header of the block file <f> and return its flags,
+    its block size and its shared code lengths (None if blocks have their
+    own trees). Raise ValueError if the header is not valid.
+    """
+    if f.read(2) != bytes([0, VERSION_BLOCKS]):
+        raise ValueError("not a block .huff file")
+    header = read_exactly(f, 5)
+    flags, block_size = header[0], bytes_to_int(header[1:])
+    if flags & ~(FLAG_SHARED_TREE | FLAG_CHECKSUM):
+        raise ValueError(f"unknown block file flags {flags}")
+    shared = None
+    if flags & FLAG_SHARED_TREE:
+        # canonical lengths write back to the same bytes, and this way <f>
+        # does not have to seek
+        shared = lengths_to_bytes(read_canonical_header(f))
+    if flags & FLAG_CHECKSUM and bytes_to_int(read_exactly(f, 4)) != \
+            zlib.crc32(bytes([0, VERSION_BLOCKS]) + header + (shared or b"")):
+        raise ValueError("the header does not match its checksum")
+    return flags, block_size, shared
+
+
+def read_frame_header(f: BinaryIO) -> tuple[int, int, int]:
+    """ Read the header of the next frame of <f> and return its kind,
+    original size and compressed size, both 0 for BLOCK_END. Raise
+    ValueError if <f> ends first.
+    """
+    kind = read_exactly(f, 1)[0]
+    if kind == BLOCK_END:
+        return kind, 0, 0
+    sizes = read_exactly(f, 8)
+    return kind, bytes_to_int(sizes[:4]), bytes_to_int(sizes[4:])
+
+
+def read_frames(f: BinaryIO) -> Iterator[tuple[int, int, int, int]]:
+    """ Yield (kind, payload offset, original size, compressed size) for
+    each frame of the open block file <f>, which is positioned after the
+    file header. Payloads are skipped, not read. Raise ValueError if the
+    file ends before BLOCK_END.
+    """
+    kind, size, compressed_size = read_frame_header(f)
+    while kind != BLOCK_END:
+        offset = f.tell()
+        yield kind, offset, size, compressed_size
+        f.seek(offset + compressed_size)
+        kind, size, compressed_size = read_frame_header(f)
+
+
+def _count_file_block(path: str, offset: int, length: int) -> dict[int, int]:
+    return build_frequency_dict_fast(_read_block(path, offset, length))
+
+
+def _encode_file_block(path: str, offset: int, length: int,
+                       shared: Optional[bytes], adaptive: bool,
+                       checksum: bool) -> bytes:
+    return encode_block(_read_block(path, offset, length), shared, adaptive,
+                        checksum)
+
+
+def _decode_file_block(path: str, kind: int, offset: int, size: int,
+                       compressed_size: int, shared: Optional[bytes],
+                       checksum: bool, out_path: str, out_offset: int) -> None:
+    block = decode_block(kind, _read_block(path, offset, compressed_size),
+                         size, shared, checksum)
+    with open(out_path, "r+b") as f:
+        f.seek(out_offset)
+        f.write(block)
+
+
+def compress_file_blocks(in_file: str, out_file: str,
+                         block_size: int = BLOCK_SIZE,
+                         per_block_trees: bool = False,
+                         workers: Optional[int] = None,
+                         adaptive: bool = False,
+                         checksum: bool = False) -> None:
+    """ Compress <in_file> into the block file <out_file>, encoding blocks of
+    <block_size> bytes on <workers> processes. All blocks share one tree
+    built from the whole file unless <per_block_trees> is True. If
+    <adaptive> is True, each block uses the shared tree or its own,
+    whichever is smaller. If <checksum> is True, the header and every block
+    get a CRC-32.
+    """
+    jobs = [(in_file, offset, block_size)
+            for offset in range(0, os.path.getsize(in_file), block_size)]
+    flags, shared = FLAG_CHECKSUM if checksum else 0, None
+    if not per_block_trees:
+        freq = {}
+        for block_freq in _run_ordered(_count_file_block, jobs, workers):
+            for symbol, count in block_freq.items():
+                freq[symbol] = freq.get(symbol, 0) + count
+        flags |= FLAG_SHARED_TREE
+        shared = lengths_to_bytes(code_lengths(build_huffman_tree_heap(freq)))
+
+    with open(out_file, "wb") as f:
+        f.write(block_header(flags, block_size, shared))
+        for frame in _run_ordered(_encode_file_block,
+                                  [job + (shared, adaptive, checksum)
+                                   for job in jobs], workers):
+            f.write(frame)
+        f.write(bytes([BLOCK_END]))
+
+
+def decompress_file_blocks(in_file: str, out_file: str,
+                           workers: Optional[int] = None) -> None:
+    """ Decompress the block file <in_file> into <out_file>, decoding blocks
+    on <workers> processes. Every block is written straight to its place in
+    the preallocated output file. If a block fails to decode or verify, the
+    partly written output file is removed.
+    """
+    with open(in_file, "rb") as f:
+        flags, _, shared = read_block_header(f)
+        checksum = bool(flags & FLAG_CHECKSUM)
+        jobs, out_offset = [], 0
+        for kind, offset, size, compressed_size in read_frames(f):
+            jobs.append((in_file, kind, offset, size, compressed_size,
+                         shared, checksum, out_file, out_offset))
+            out_offset += size
+
+    with open(out_file, "wb") as g:
+        g.truncate(out_offset)
+    try:
+        for _ in _run_ordered(_decode_file_block, jobs, workers):
+            pass
+    except BaseException:
+        os.remove(out_file)
+        raise
+
+
+def decompress_file_any(in_file: str, out_file: str,
+                        workers: Optional[int] = None) -> None:
+    """ Decompress <in_file> into <out_file>, as a block file on <workers>
+    processes or as a single-stream .huff file, whichever it is.
+    """
+    if is_block_file(in_file):
+        decompress_file_blocks(in_file, out_file, workers)
+    else:
+        decompress_file(in_file, out_file)
+
+
+def read_range_blocks(path: str, start: int, length: int) -> bytes:
+    """ Return <length> original bytes of the block file <path> from offset
+    <start>, decoding only the blocks that overlap that range.
+    """
+    result, end = bytearray(), start + length
+    with open(path, "rb") as f:
+        flags, _, shared = read_block_header(f)
+        block_start = 0
+        for kind, offset, size, compressed_size in read_frames(f):
+            block_end = block_start + size
+            if block_start >= end:
+                break
+            if block_end > start:
+                # read_frames seeks past the payload itself
+                f.seek(offset)
+                block = decode_block(kind, f.read(compressed_size), size,
+                                     shared, bool(flags & FLAG_CHECKSUM))
+                result += block[max(start - block_start, 0):end - block_start]
+            block_start = block_end
+    return bytes(result)
+
+
+# Verification: the header and frame structure are checked in the calling
+# process, then the blocks on a pool. Blocks with checksums are only checked
+# against them; blocks without are decoded in memory instead.
+
+def _verify_file_block(path: str, index: int, kind: int, offset: int,
+                       size: int, compressed_size: int,
+                       shared: Optional[bytes], checksum: bool) -> None:
+    payload = _read_block(path, offset, compressed_size)
+    try:
+        if len(payload) != compressed_size:
+            raise ValueError("the block file is truncated")
+        if checksum:
+            check_frame(kind, payload, size, shared, checksum)
+        else:
+            decode_block(kind, payload, size, shared)
+    except (ValueError, IndexError) as e:
+        raise ValueError(f"block {index}: {e}") from None
+
+
+def verify_file_blocks(path: str, workers: Optional[int] = None) -> int:
+    """ Check the block file <path> without writing anything, checking
+    blocks on <workers> processes, and return its number of blocks.
+    Raise ValueError at the first problem found.
+    """
+    with open(path, "rb") as f:
+        flags, _, shared = read_block_header(f)
+        jobs = [(path, index, kind, offset, size, compressed_size, shared,
+                 bool(flags & FLAG_CHECKSUM))
+                for index, (kind, offset, size, compressed_size)
+                in enumerate(read_frames(f))]
+        if f.read(1):
+            raise ValueError("the block file has data after BLOCK_END")
+    for _ in _run_ordered(_verify_file_block, jobs, workers):
+        pass
+    return len(jobs)
+
+
+# Streaming: single pass over a stream of chunks, holding at most one block.
+# Only blocks with their own trees can be written this way, since a shared
+# tree needs the frequencies of the whole input first.
+
+def compress_stream(chunks: Iterable[bytes], block_size: int = BLOCK_SIZE,
+                    adaptive: bool = False,
+                    checksum: bool = False) -> Iterator[bytes]:
+    """ Yield a block file with a tree per block for the input given as a
+    stream of <chunks>, one frame at a time. If <adaptive> is True, the tree
+    of the first block is shared, and later blocks only get their own tree
+    when that makes their frame smaller. If <checksum> is True, the header
+    and every block get a CRC-32.
+    """
+    buf, shared, header = bytearray(), None, None
+    for chunk in chunks:
+        buf += chunk
+        while len(buf) >= block_size:
+            block = bytes(buf[:block_size])
+            del buf[:block_size]
+            if header is None:
+                shared, header = _stream_header(block, block_size, adaptive,
+                                                checksum)
+                yield header
+            yield encode_block(block, shared, adaptive, checksum)
+    if header is None:
+        shared, header = _stream_header(bytes(buf), block_size, adaptive,
+                                        checksum)
+        yield header
+    if buf:
+        yield encode_block(bytes(buf), shared, adaptive, checksum)
+    yield bytes([BLOCK_END])
+
+
+def _stream_header(block: bytes, block_size: int, adaptive: bool,
+                   checksum: bool) -> tuple[Optional[bytes], bytes]:
+    """ Return the shared code lengths, built from the first <block> in
+    adaptive mode, and the block file header.
+    """
+    flags = FLAG_CHECKSUM if checksum else 0
+    if not adaptive or not block:
+        return None, block_header(flags, block_size)
+    shared = lengths_to_bytes(code_lengths(build_huffman_tree_heap(
+        build_frequency_dict_fast(block))))
+    return shared, block_header(flags | FLAG_SHARED_TREE, block_size, shared)
+
+
+def decompress_stream_blocks(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    """ Yield the original bytes of a block file given as a stream of
+    <chunks>, one block at a time.
+    """
+    f = ChunkReader(chunks)
+    flags, _, shared = read_block_header(f)
+    kind, size, compressed_size = read_frame_header(f)
+    while kind != BLOCK_END:
+        yield decode_block(kind, read_exactly(f, compressed_size), size,
+                           shared, bool(flags & FLAG_CHECKSUM))
+        kind, size, compressed_size = read_frame_header(f)
+
+
+def decompress_stream_any(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    """ Yield the original bytes of a block file or a single-stream .huff
+    file given as a stream of <chunks>.
+    """
+    f = ChunkReader(chunks)
+    if f.peek(2) == bytes([0, VERSION_BLOCKS]):
+        return decompress_stream_blocks(f)
+    return decompress_stream(f)
@@ -0,0 +1,155 @@
+"""
+Content-addressed cache of compression results for the web service.
+
+A result is stored under the SHA-256 of the uploaded bytes and the operation
+that produced it, so uploading the same file again is answered from the
+cache without building a tree or encoding anything. The cache keeps its
+total size under a budget by evicting the least recently used results.
+"""
+from __future__ import annotations
+
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import BinaryIO
+
+# bump to drop results written by an older compressor
+CACHE_VERSION = 1
+
+
+def save_and_hash(stream: BinaryIO, path: str,
+                  chunk_size: int = 1 << 20) -> str:
+    """ Copy <stream> to the file <path> and return the hex SHA-256 of the
+    bytes copied.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'wb') as f:
+        for chunk in iter(lambda: stream.read(chunk_size), b''):
+            digest.update(chunk)
+            f.write(chunk)
+    return digest.hexdigest()
+
+
+def cache_key(digest: str, operation: str) -> str:
+    """ Return the cache key for the result of <operation> on the bytes with
+    SHA-256 <digest>.
+
+    >>> cache_key('ab12', 'compress')
+    'v1-compress-ab12'
+    """
+    return f'v{CACHE_VERSION}-{operation}-{digest}'
+
+
+class ResultCache:
+    """ A directory of result files with a size budget and LRU eviction.
+
+    Public Attributes:
+    ===========
+    directory: where the cached results are stored
+    max_bytes: the most bytes of results to keep
+    hits: number of lookups that found a result
+    misses: number of lookups that did not
+    evictions: number of results evicted to stay under max_bytes
+    """
+    directory: str
+    max_bytes: int
+    hits: int
+    misses: int
+    evictions: int
+    _entries: OrderedDict[str, int]
+
+    def __init__(self, directory: str, max_bytes: int) -> None:
+        """ Create a new ResultCache in <directory>, picking up results that
+        are already there, oldest first.
+        """
+        self.directory, self.max_bytes = directory, max_bytes
+        self.hits = self.misses = self.evictions = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        found = []
+        for entry in os.scandir(directory):
+            if entry.is_file() and not entry.name.endswith('.tmp'):
+                stat = entry.stat()
+                found.append((stat.st_mtime, entry.name, stat.st_size))
+        self._entries = OrderedDict((key, size)
+                                    for _, key, size in sorted(found))
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def size(self) -> int:
+        """ Return the total size of the cached results in bytes."""
+        return sum(self._entries.values())
+
+    def copy_to(self, key: str, dst: str) -> bool:
+        """ Copy the result for <key> to the file <dst> and return True, or
+        return False on a miss. The result is opened under the lock, so a
+        put() that evicts it during the copy cannot remove it from under the
+        copy.
+        """
+        with self._lock:
+            f = None
+            if key in self._entries:
+                try:
+                    f = open(self._path(key), 'rb')
+                except FileNotFoundError:  # removed from outside the cache
+                    pass
+            if f is None:
+                self._entries.pop(key, None)
+                self.misses += 1
+                return False
+            self._entries.move_to_end(key)
+            self.hits += 1
+            os.utime(self._path(key))  # keep the order across restarts
+        with f, open(dst, 'wb') as g:
+            shutil.copyfileobj(f, g)
+        return True
+
+    def put(self, key: str, src: str) -> str:
+        """ Copy the result file <src> into the cache under <key> and return
+        its path in the cache. Results larger than the budget are not kept.
+        """
+        size = os.path.getsize(src)
+        if size > self.max_bytes:
+            return src
+        # a temp file per writer, so two requests storing the same result
+        # at once do not write into one file, and readers only ever see
+        # whole results
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as g, open(src, 'rb') as f:
+                shutil.copyfileobj(f, g)
+        except BaseException:
+            os.remove(tmp)
+            raise
+        with self._lock:
+            os.replace(tmp, self._path(key))
+            self._entries[key] = size
+            self._entries.move_to_end(key)
+            total = self.size()
+            while total > self.max_bytes:
+                old_key, old_size = self._entries.popitem(last=False)
+                try:
+                    os.remove(self._path(old_key))
+                except FileNotFoundError:
+                    pass
+                total -= old_size
+                self.evictions += 1
+        return self._path(key)
+
+    def metrics(self) -> str:
+        """ Return the cache counters in the Prometheus text format."""
+        lines = []
+        for name, kind, value in (
+                ('hits_total', 'counter', self.hits),
+                ('misses_total', 'counter', self.misses),
+                ('evictions_total', 'counter', self.evictions),
+                ('entries', 'gauge', len(self._entries)),
+                ('bytes', 'gauge', self.size()),
+                ('max_bytes', 'gauge', self.max_bytes)):
+            lines.append(f'# TYPE huffman_cache_{name} {kind}')
+            lines.append(f'huffman_cache_{name} {value}')
+        return '\n'.join(lines) + '\n'
@@ -1,10 +1,26 @@
 from __future__ import annotations
 
+import bisect
+import contextlib
+import contextvars
+import heapq
+import math
+import mmap
+import os
 import time
+import tracemalloc
+from collections import Counter, deque
+from typing import BinaryIO, Callable, Iterable, Iterator, Optional
 
+from flat_tree import FlatTree
 from huffman import HuffmanTree
 from utils import *
 
+try:
+    import numpy as np
+except ImportError:  # numpy is optional, see build_frequency_dict_fast
+    np = None
+
 def build_frequency_dict(text: bytes) -> dict[int, int]:
     freq_dict = {}
     for bit in text:
@@ -12,6 +28,21 @@ def build_frequency_dict(text: bytes) -> dict[int, int]:
     return freq_dict
 
 
+def build_frequency_dict_fast(text: bytes) -> dict[int, int]:
+    # same dict as build_frequency_dict, keys in order of first appearance
+    # (build_huffman_tree breaks ties by that order)
+    if np is None:
+        return dict(Counter(text))
+    counts = np.bincount(np.frombuffer(text, dtype=np.uint8), minlength=256)
+    num_symbols = int(np.count_nonzero(counts))
+    view, order = memoryview(text).cast("B"), {}
+    for i in range(0, len(view), DECODE_CHUNK):
+        order.update(dict.fromkeys(view[i:i + DECODE_CHUNK].tobytes()))
+        if len(order) == num_symbols:
+            break
+    return {sym: int(counts[sym]) for sym in order}
+
+
 def build_huffman_tree(freq_dict: dict[int, int]) -> HuffmanTree:
     if len(freq_dict) == 0:
         return HuffmanTree(None, HuffmanTree(None), HuffmanTree(None))
@@ -39,6 +70,28 @@ def build_huffman_tree(freq_dict: dict[int, int]) -> HuffmanTree:
     return freq_list[0][1] if freq_list else HuffmanTree(None)
 
 
+def build_huffman_tree_heap(freq_dict: dict[int, int]) -> HuffmanTree:
+    # same result as build_huffman_tree in O(n log n): ties between equal
+    # frequencies go to the older entry, like the stable sort there, where
+    # the starting order is the dict order and merged trees come last
+    if len(freq_dict) < 2:
+        return build_huffman_tree(freq_dict)
+    symbols = sorted(freq_dict, key=freq_dict.get)
+    heap = [(freq_dict[sym], i, HuffmanTree(sym))
+            for i, sym in enumerate(symbols)]
+    # a sorted list is already a heap
+    order = len(heap)
+
+    while len(heap) > 1:
+        tree1_freq, _, tree1 = heapq.heappop(heap)
+        tree2_freq, _, tree2 = heapq.heappop(heap)
+        heapq.heappush(heap, (tree1_freq + tree2_freq, order,
+                              HuffmanTree(None, tree1, tree2)))
+        order += 1
+
+    return heap[0][2]
+
+
 def get_codes(tree: HuffmanTree) -> dict[int, str]:
     codes = {}
     tree_lst = [{'node': tree, 'code': ''}]
@@ -60,6 +113,45 @@ def get_codes(tree: HuffmanTree) -> dict[int, str]:
     return codes
 
 
+def get_code_arrays(tree: HuffmanTree) -> tuple[list[int], list[int]]:
+    # the same as get_code_pairs(get_codes(tree)), but codes are built as
+    # integers on three parallel stacks instead of strings in dicts
+    values, lengths = [0] * 256, [0] * 256
+    nodes, codes, depths = [tree], [0], [0]
+    while nodes:
+        node, code, depth = nodes.pop(), codes.pop(), depths.pop()
+        if node.left is None and node.right is None:
+            symbol = node.symbol
+            if symbol is None:  # the empty tree from build_huffman_tree
+                continue
+            if symbol >= len(values):
+                values.extend([0] * (symbol + 1 - len(values)))
+                lengths.extend([0] * (symbol + 1 - len(lengths)))
+            values[symbol], lengths[symbol] = code, depth
+            continue
+        if node.right is not None:
+            nodes.append(node.right)
+            codes.append(code << 1 | 1)
+            depths.append(depth + 1)
+        if node.left is not None:
+            nodes.append(node.left)
+            codes.append(code << 1)
+            depths.append(depth + 1)
+    return values, lengths
+
+
+def level_order(tree: HuffmanTree) -> Iterator[HuffmanTree]:
+    # breadth-first, left to right; a deque pops from the front in O(1)
+    queue = deque([tree])
+    while queue:
+        node = queue.popleft()
+        yield node
+        if node.left is not None:
+            queue.append(node.left)
+        if node.right is not None:
+            queue.append(node.right)
+
+
 def number_nodes(tree: HuffmanTree) -> None:
     num_list = [tree]
     visited_list = [False]
@@ -87,10 +179,10 @@ def number_nodes(tree: HuffmanTree) -> None:
 def avg_length(tree: HuffmanTree, freq_dict: dict[int, int]) -> float:
     if tree.is_leaf() or not freq_dict.values():
         return 0
-    dict_codes = get_codes(tree)
+    lengths = get_code_arrays(tree)[1]
     tot_freq = 0
     for key in freq_dict:
-        tot_freq += len(dict_codes[key]) * freq_dict[key]
+        tot_freq += lengths[key] * freq_dict[key]
     return tot_freq / sum(freq_dict.values())
 
 
@@ -108,6 +200,67 @@ def compress_bytes(text: bytes, codes: dict[int, str]) -> bytes:
     return bytes(compressed_lst)
 
 
+def get_code_pairs(codes: dict[int, str]) -> tuple[list[int], list[int]]:
+    # code values and code lengths indexed by symbol; the empty tree from
+    # build_huffman_tree has leaves without a symbol, which never occur
+    codes = {sym: codes[sym] for sym in codes if sym is not None}
+    size = max(max(codes, default=0) + 1, 256)
+    values, lengths = [0] * size, [0] * size
+    for symbol, code in codes.items():
+        values[symbol] = int(code, 2) if code else 0
+        lengths[symbol] = len(code)
+    return values, lengths
+
+
+def pack_codes(text: bytes, pairs: tuple[list[int], list[int]],
+               acc: int, nbits: int, out: bytearray) -> tuple[int, int]:
+    # append the codes of text to acc and move every complete 64 bits
+    # into out; returns the leftover (acc, nbits), nbits < 64
+    values, lengths = pairs
+    for symbol in text:
+        length = lengths[symbol]
+        acc = (acc << length) | values[symbol]
+        nbits += length
+        if nbits >= 64:
+            nbits -= 64
+            out += (acc >> nbits).to_bytes(8, 'big')
+            acc &= (1 << nbits) - 1
+    return acc, nbits
+
+
+def flush_bits(acc: int, nbits: int, out: bytearray) -> None:
+    # pad the last partial byte with 0s
+    pad = -nbits % 8
+    out += (acc << pad).to_bytes((nbits + pad) // 8, 'big')
+
+
+def pack_codes_indexed(text: bytes, pairs: tuple[list[int], list[int]],
+                       acc: int, nbits: int, out: bytearray,
+                       index: list[tuple[int, int]], interval: int,
+                       offset: int, written: int) -> tuple[int, int]:
+    # pack_codes that also appends (original offset, bit offset in the
+    # file) to index whenever the original offset is a multiple of interval;
+    # text starts at original offset <offset>, and <written> bytes of the
+    # file come before out
+    if interval <= 0:
+        return pack_codes(text, pairs, acc, nbits, out)
+    view, i = memoryview(text), 0
+    while i < len(view):
+        end = i + interval - (offset + i) % interval
+        if end - i == interval:
+            index.append((offset + i, (written + len(out)) * 8 + nbits))
+        acc, nbits = pack_codes(view[i:end], pairs, acc, nbits, out)
+        i = end
+    return acc, nbits
+
+
+def compress_bytes_packed(text: bytes, codes: dict[int, str]) -> bytes:
+    out = bytearray()
+    acc, nbits = pack_codes(text, get_code_pairs(codes), 0, 0, out)
+    flush_bits(acc, nbits, out)
+    return bytes(out)
+
+
 def tree_to_bytes(tree: HuffmanTree) -> bytes:
     if tree.is_leaf() or not tree:
         return bytes([])
@@ -147,19 +300,584 @@ def tree_to_bytes(tree: HuffmanTree) -> bytes:
     return bytes(list_of_bytes)
 
 
-def compress_file(in_file: str, out_file: str) -> None:
-    with open(in_file, "rb") as f1:
+# ====================
+# Canonical Huffman codes
+#
+# A canonical code is fully determined by the length of each symbol's code:
+# symbols sorted by (length, symbol) get consecutive code values, shifted
+# left whenever the length grows. The header then only stores the lengths,
+# as a count of symbols per length followed by the symbols in that order.
+# Versioned files start with a 0 byte, which is never the node count of a
+# tree_to_bytes header, followed by the format version.
+
+VERSION_CANONICAL = 1
+
+
+def code_lengths(tree: HuffmanTree) -> dict[int, int]:
+    lengths = get_code_arrays(tree)[1]
+    return {node.symbol: lengths[node.symbol] for node in level_order(tree)
+            if node.is_leaf() and node.symbol is not None}
+
+
+def canonical_order(lengths: dict[int, int]) -> list[int]:
+    return sorted(lengths, key=lambda sym: (lengths[sym], sym))
+
+
+def canonical_code_pairs(lengths: dict[int, int]) \
+        -> tuple[list[int], list[int]]:
+    size = max(max(lengths, default=0) + 1, 256)
+    values, code_lens = [0] * size, [0] * size
+    code, prev_length = 0, 0
+    for symbol in canonical_order(lengths):
+        length = lengths[symbol]
+        code <<= length - prev_length
+        values[symbol], code_lens[symbol] = code, length
+        code, prev_length = code + 1, length
+    return values, code_lens
+
+
+def lengths_to_bytes(lengths: dict[int, int]) -> bytes:
+    max_length = max(lengths.values(), default=0)
+    counts = [0] * (max_length + 1)
+    for length in lengths.values():
+        counts[length] += 1
+    result = bytearray([max_length])
+    for count in counts[1:]:
+        result += count.to_bytes(2, "little")
+    return bytes(result + bytes(canonical_order(lengths)))
+
+
+def canonical_header(lengths: dict[int, int]) -> bytes:
+    return bytes([0, VERSION_CANONICAL]) + lengths_to_bytes(lengths)
+
+
+def read_exactly(f: BinaryIO, n: int) -> bytes:
+    # like f.read(n), but a file cut short is an error, not a short read;
+    # every .huff reader, blocks.py and asgi.py included, goes through here
+    buf = f.read(n)
+    if len(buf) != n:
+        raise ValueError("the .huff file is truncated")
+    return buf
+
+
+def read_canonical_header(f: BinaryIO) -> dict[int, int]:
+    # reads lengths_to_bytes output, which follows the version byte
+    max_length = read_exactly(f, 1)[0]
+    counts = [bytes_to_int(read_exactly(f, 2)) for _ in range(max_length)]
+    symbols = read_exactly(f, sum(counts))
+    # more codes than the lengths allow would overwrite each other in
+    # canonical_flat_tree (the Kraft sum of a prefix code is at most 1)
+    if sum(count << (max_length - length)
+           for length, count in enumerate(counts, 1)) > 1 << max_length:
+        raise ValueError("the code lengths do not form a prefix code")
+    lengths, i = {}, 0
+    for length, count in enumerate(counts, 1):
+        for symbol in symbols[i:i + count]:
+            lengths[symbol] = length
+        i += count
+    if len(lengths) != len(symbols):
+        raise ValueError("a symbol has more than one code length")
+    return lengths
+
+
+def canonical_flat_tree(lengths: dict[int, int]) \
+        -> tuple[list[int], list[int]]:
+    # the same node arrays as flatten_tree, built straight from the codes
+    values, code_lens = canonical_code_pairs(lengths)
+    left, right = [0], [0]
+    for symbol in lengths:
+        code, node = values[symbol], 0
+        for shift in range(code_lens[symbol] - 1, 0, -1):
+            children = right if code >> shift & 1 else left
+            if children[node] == 0:  # the root is never a child
+                children[node] = len(left)
+                left.append(0)
+                right.append(0)
+            node = children[node]
+        (right if code & 1 else left)[node] = ~symbol
+    return left, right
+
+
+def _code_header(tree: HuffmanTree, canonical: bool) \
+        -> tuple[bytes, tuple[list[int], list[int]]]:
+    # the header bytes before the size, and the (value, length) code pairs
+    if canonical:
+        lengths = code_lengths(tree)
+        return canonical_header(lengths), canonical_code_pairs(lengths)
+    if tree.left is None or tree.left.symbol is None and tree.left.is_leaf():
+        # the tree of an empty input has no symbols and an empty node table
+        return bytes([1]), get_code_pairs({})
+    flat = FlatTree.from_tree(tree)
+    return flat.num_nodes_to_bytes() + flat.tree_to_bytes(), flat.code_pairs()
+
+
+# Length-limited codes: Huffman codes for very skewed inputs can be up to
+# n - 1 bits long. Package-merge finds the best code lengths that are at
+# most max_length bits, and the tree is rebuilt from those lengths with
+# canonical codes, so it fits both header formats.
+
+def package_merge_lengths(freq_dict: dict[int, int],
+                          max_length: int) -> dict[int, int]:
+    if len(freq_dict) < 2:
+        return {sym: 1 for sym in freq_dict}
+    if len(freq_dict) > 1 << max_length:
+        raise ValueError(f"{len(freq_dict)} symbols do not fit in "
+                         f"{max_length}-bit codes")
+    # an item is (weight, order, symbol) for a leaf, or (weight, order,
+    # (item, item)) for a package; a leaf sorts before a package of the
+    # same weight
+    leaves = sorted((freq_dict[sym], i, sym)
+                    for i, sym in enumerate(freq_dict))
+    items = leaves
+    for _ in range(max_length - 1):
+        packages = [(items[i][0] + items[i + 1][0], len(leaves) + i,
+                     (items[i], items[i + 1]))
+                    for i in range(0, len(items) - 1, 2)]
+        items = list(heapq.merge(leaves, packages))
+
+    # every time a symbol is in one of the chosen items, its code gets
+    # one bit longer
+    lengths = dict.fromkeys(freq_dict, 0)
+    stack = items[:2 * len(leaves) - 2]
+    while stack:
+        content = stack.pop()[2]
+        if isinstance(content, tuple):
+            stack.extend(content)
+        else:
+            lengths[content] += 1
+    return lengths
+
+
+def tree_from_lengths(lengths: dict[int, int]) -> HuffmanTree:
+    if len(lengths) < 2:
+        return build_huffman_tree(dict.fromkeys(lengths, 1))
+    values, code_lens = canonical_code_pairs(lengths)
+    tree = HuffmanTree(None)
+    for symbol in lengths:
+        node, length = tree, code_lens[symbol]
+        for shift in range(length - 1, -1, -1):
+            bit = values[symbol] >> shift & 1
+            child = node.right if bit else node.left
+            if child is None:
+                child = HuffmanTree(symbol if shift == 0 else None)
+                if bit:
+                    node.right = child
+                else:
+                    node.left = child
+            node = child
+    return tree
+
+
+def build_huffman_tree_limited(freq_dict: dict[int, int],
+                               max_length: int) -> HuffmanTree:
+    # the usual tree when its codes are short enough, so the output only
+    # changes for inputs that need the limit
+    tree = build_huffman_tree_heap(freq_dict)
+    if max_length <= 0 \
+            or max(code_lengths(tree).values(), default=0) <= max_length:
+        return tree
+    return tree_from_lengths(package_merge_lengths(freq_dict, max_length))
+
+
+# Stored files: input that is already compressed has close to 8 bits of
+# entropy per byte, and no code makes it smaller. Such input is copied after
+# a short header instead of being coded:
+#
+#     0, VERSION_STORED, original size (4 bytes), original bytes
+#
+# The entropy of the byte frequencies is a lower bound on the bits per
+# symbol of any code, so above STORED_ENTROPY no tree is built at all. Input
+# whose header and codes still come out no smaller than the original is
+# stored as well.
+
+VERSION_STORED = 5
+STORED_ENTROPY = 7.9
+
+
+def entropy(freq_dict: dict[int, int]) -> float:
+    # bits per symbol of an ideal code for these frequencies
+    total = sum(freq_dict.values())
+    if total == 0:
+        return 0.0
+    return math.log2(total) - sum(
+        count * math.log2(count) for count in freq_dict.values()
+        if count) / total
+
+
+def stored_header(size: int) -> bytes:
+    return bytes([0, VERSION_STORED]) + int32_to_bytes(size)
+
+
+def _codes_are_larger(freq_dict: dict[int, int], header: bytes,
+                      pairs: tuple[list[int], list[int]]) -> bool:
+    # True if the coded bytes and their header take no less room than the
+    # original bytes behind a stored header
+    num_bits = sum(pairs[1][sym] * freq_dict[sym] for sym in freq_dict)
+    return len(header) + (num_bits + 7) // 8 >= 2 + sum(freq_dict.values())
+
+
+def _choose_codes(freq_dict: dict[int, int], canonical: bool,
+                  max_code_length: int, allow_stored: bool
+                  ) -> tuple[bool, Optional[HuffmanTree], bytes,
+                             tuple[list[int], list[int]]]:
+    # Decide between a stored block and a Huffman tree for these byte counts:
+    # (stored, tree, header, pairs), where tree, header and pairs are only
+    # filled in if a tree was built
+    tree, header, pairs = None, b"", ([], [])
+    stored = allow_stored and entropy(freq_dict) >= STORED_ENTROPY
+    if not stored:
+        with _stage("build"):
+            tree = build_huffman_tree_limited(freq_dict, max_code_length)
+        with _stage("codes") as stage:
+            header, pairs = _code_header(tree, canonical)
+            stage.bytes_out = len(header)
+        stored = allow_stored and _codes_are_larger(freq_dict, header, pairs)
+    record_bits_per_symbol(8 if stored else avg_length(tree, freq_dict))
+    return stored, tree, header, pairs
+
+
+# An optional index after the compressed bits lists checkpoints, as
+# (original offset, bit offset in the file) pairs of 8 bytes each, followed
+# by the number of checkpoints (4 bytes) and INDEX_MAGIC. The size in the
+# header tells decoders where the data ends, so they ignore the index.
+
+INDEX_MAGIC = b"HIDX"
+INDEX_INTERVAL = 1 << 16
+
+
+def index_to_bytes(index: list[tuple[int, int]]) -> bytes:
+    if not index:
+        return b""
+    result = bytearray()
+    for offset, bit_offset in index:
+        result += offset.to_bytes(8, "little")
+        result += bit_offset.to_bytes(8, "little")
+    return bytes(result + int32_to_bytes(len(index)) + INDEX_MAGIC)
+
+
+# Instrumentation: inside a record_stages() block, compress_file and
+# decompress_file record the wall time, bytes in and out and (optionally)
+# the peak memory allocated by each stage of the pipeline. Outside such a
+# block the stages cost one context variable lookup each.
+
+class StageStats:
+    """ What one stage of the pipeline did.
+
+    Public Attributes:
+    ===========
+    seconds: wall time spent in the stage
+    bytes_in: bytes the stage consumed
+    bytes_out: bytes the stage produced
+    peak_bytes: most memory allocated at once during the stage, above what
+        was allocated when it started (0 unless memory is traced)
+    """
+    seconds: float
+    bytes_in: int
+    bytes_out: int
+    peak_bytes: int
+
+    def __init__(self) -> None:
+        self.seconds = 0.0
+        self.bytes_in = self.bytes_out = self.peak_bytes = 0
+
+    def __repr__(self) -> str:
+        return (f'StageStats({self.seconds:.6f}, {self.bytes_in}, '
+                f'{self.bytes_out}, {self.peak_bytes})')
+
+
+class PipelineStats:
+    """ The stages recorded inside one record_stages() block, in order.
+    A stage that runs more than once adds up.
+
+    Public Attributes:
+    ===========
+    stages: StageStats by stage name ("read", "count", "build", "codes",
+        "encode", "decode" or "write")
+    trace_memory: whether peak_bytes is measured
+    bits_per_symbol: the average code length of the last file compressed,
+        8 if it was stored, or None if no file was compressed
+    """
+    stages: dict[str, StageStats]
+    trace_memory: bool
+    bits_per_symbol: Optional[float]
+
+    def __init__(self, trace_memory: bool = False) -> None:
+        self.stages = {}
+        self.trace_memory = trace_memory
+        self.bits_per_symbol = None
+
+    def total_seconds(self) -> float:
+        return sum(stage.seconds for stage in self.stages.values())
+
+    def as_dict(self) -> dict[str, dict[str, float]]:
+        return {name: {"seconds": stage.seconds, "bytes_in": stage.bytes_in,
+                       "bytes_out": stage.bytes_out,
+                       "peak_bytes": stage.peak_bytes}
+                for name, stage in self.stages.items()}
+
+    def __str__(self) -> str:
+        """ Return one line per pipeline, for logs.
+
+        >>> stats = PipelineStats()
+        >>> stats.stages["read"] = StageStats()
+        >>> stats.stages["read"].bytes_out = 2048
+        >>> str(stats)
+        'read 0.0ms 0B->2048B'
+        """
+        parts = []
+        for name, stage in self.stages.items():
+            part = (f'{name} {stage.seconds * 1000:.1f}ms '
+                    f'{stage.bytes_in}B->{stage.bytes_out}B')
+            if self.trace_memory:
+                part += f' peak {stage.peak_bytes}B'
+            parts.append(part)
+        if self.bits_per_symbol is not None:
+            parts.append(f'{self.bits_per_symbol:.3f} bits/symbol')
+        return ', '.join(parts)
+
+
+_current_stats = contextvars.ContextVar("_current_stats", default=None)
+
+
+@contextlib.contextmanager
+def record_stages(callback: Optional[Callable[[PipelineStats], None]] = None,
+                  trace_memory: bool = False) -> Iterator[PipelineStats]:
+    # tracemalloc slows every allocation down and its peak is per process,
+    # so trace_memory is for debugging one request at a time
+    stats = PipelineStats(trace_memory)
+    token = _current_stats.set(stats)
+    started_tracing = trace_memory and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    try:
+        yield stats
+    finally:
+        if started_tracing:
+            tracemalloc.stop()
+        _current_stats.reset(token)
+        if callback is not None:
+            callback(stats)
+
+
+@contextlib.contextmanager
+def _stage(name: str) -> Iterator[StageStats]:
+    # the caller fills in bytes_in and bytes_out of the yielded StageStats
+    stats = _current_stats.get()
+    record = StageStats()
+    if stats is None:
+        yield record
+        return
+    if stats.trace_memory:
+        start_memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record.seconds = time.perf_counter() - start
+        if stats.trace_memory:
+            record.peak_bytes = max(
+                tracemalloc.get_traced_memory()[1] - start_memory, 0)
+        total = stats.stages.setdefault(name, StageStats())
+        total.seconds += record.seconds
+        total.bytes_in += record.bytes_in
+        total.bytes_out += record.bytes_out
+        total.peak_bytes = max(total.peak_bytes, record.peak_bytes)
+
+
+def record_bits_per_symbol(bits: float) -> None:
+    # called by the compressors; kept only inside a record_stages() block
+    stats = _current_stats.get()
+    if stats is not None:
+        stats.bits_per_symbol = bits
+
+
+def compress_file(in_file: str, out_file: str, canonical: bool = False,
+                  index_interval: int = 0, max_code_length: int = 0,
+                  allow_stored: bool = True) -> None:
+    with _stage("read") as stage, open(in_file, "rb") as f1:
         text = f1.read()
-    freq = build_frequency_dict(text)
-    tree = build_huffman_tree(freq)
-    codes = get_codes(tree)
-    number_nodes(tree)
-    print("Bits per symbol:", avg_length(tree, freq))
-    result = (tree.num_nodes_to_bytes() + tree_to_bytes(tree)
-              + int32_to_bytes(len(text)))
-    result += compress_bytes(text, codes)
-    with open(out_file, "wb") as f2:
+        stage.bytes_out = len(text)
+    with _stage("count") as stage:
+        freq = build_frequency_dict_fast(text)
+        stage.bytes_in = len(text)
+    stored, _, header, pairs = _choose_codes(freq, canonical, max_code_length,
+                                             allow_stored)
+    with _stage("encode") as stage:
+        if stored:
+            result = stored_header(len(text)) + text
+        else:
+            result = _encode_text(text, header, pairs, index_interval)
+        stage.bytes_in, stage.bytes_out = len(text), len(result)
+    with _stage("write") as stage, open(out_file, "wb") as f2:
         f2.write(result)
+        stage.bytes_in = stage.bytes_out = len(result)
+
+
+def _encode_text(text: bytes, header: bytes,
+                 pairs: tuple[list[int], list[int]],
+                 index_interval: int) -> bytearray:
+    result = bytearray(header + int32_to_bytes(len(text)))
+    index = []
+    acc, nbits = pack_codes_indexed(text, pairs, 0, 0, result,
+                                    index, index_interval, 0, 0)
+    flush_bits(acc, nbits, result)
+    return result + index_to_bytes(index)
+
+
+# Streaming versions of compress_file and decompress_file: the file is read
+# CHUNK_SIZE bytes at a time (twice when compressing: once to count, once to
+# encode), so memory use does not grow with the file size.
+
+CHUNK_SIZE = 1 << 20
+
+
+def read_chunks(f: BinaryIO, chunk_size: int) -> Iterator[bytes]:
+    chunk = f.read(chunk_size)
+    while chunk:
+        yield chunk
+        chunk = f.read(chunk_size)
+
+
+# called with (bytes done, total bytes) as a file is processed
+Progress = Callable[[int, int], None]
+
+
+def _with_progress(chunks: Iterable[bytes], progress: Optional[Progress],
+                   total: int, done: int = 0) -> Iterator[bytes]:
+    # report (bytes read so far, total) to progress after each chunk
+    for chunk in chunks:
+        yield chunk
+        done += len(chunk)
+        if progress is not None:
+            progress(done, total)
+
+
+class ChunkReader:
+    """ A file-like reader over an iterable of byte chunks, such as a request
+    body, so headers can be read with read(n) from a stream that cannot seek.
+    Iterating over a ChunkReader yields the chunks that were not read yet.
+    """
+    def __init__(self, chunks: Iterable[bytes]) -> None:
+        self._chunks = iter(chunks)
+        self._buf = bytearray()
+
+    def _fill(self, n: int) -> None:
+        while len(self._buf) < n:
+            chunk = next(self._chunks, b"")
+            if not chunk:
+                break
+            self._buf += chunk
+
+    def peek(self, n: int) -> bytes:
+        """ Return the next <n> bytes without consuming them."""
+        self._fill(n)
+        return bytes(self._buf[:n])
+
+    def read(self, n: int) -> bytes:
+        """ Return the next <n> bytes, or fewer at the end of the stream."""
+        self._fill(n)
+        result = bytes(self._buf[:n])
+        del self._buf[:n]
+        return result
+
+    def __iter__(self) -> Iterator[bytes]:
+        if self._buf:
+            yield bytes(self._buf)
+            self._buf.clear()
+        yield from self._chunks
+
+
+def compress_file_stream(in_file: str, out_file: str,
+                         chunk_size: int = CHUNK_SIZE,
+                         canonical: bool = False,
+                         index_interval: int = 0,
+                         progress: Optional[Progress] = None,
+                         max_code_length: int = 0,
+                         allow_stored: bool = True) -> None:
+    # the input is read twice, so progress goes up to twice its size
+    freq, size, total = {}, 0, 2 * os.path.getsize(in_file)
+    with open(in_file, "rb") as f1:
+        for chunk in _with_progress(read_chunks(f1, chunk_size),
+                                    progress, total):
+            for symbol, count in build_frequency_dict_fast(chunk).items():
+                freq[symbol] = freq.get(symbol, 0) + count
+            size += len(chunk)
+    stored, _, header, pairs = _choose_codes(freq, canonical, max_code_length,
+                                             allow_stored)
+
+    if stored:
+        with open(in_file, "rb") as f1, open(out_file, "wb") as f2:
+            f2.write(stored_header(size))
+            for chunk in _with_progress(read_chunks(f1, chunk_size),
+                                        progress, total, size):
+                f2.write(chunk)
+        return
+    with open(in_file, "rb") as f1, open(out_file, "wb") as f2:
+        f2.write(header + int32_to_bytes(size))
+        acc, nbits, out = 0, 0, bytearray()
+        offset, index = 0, []
+        for chunk in _with_progress(read_chunks(f1, chunk_size),
+                                    progress, total, size):
+            acc, nbits = pack_codes_indexed(chunk, pairs, acc, nbits, out,
+                                            index, index_interval,
+                                            offset, f2.tell())
+            f2.write(out)
+            offset += len(chunk)
+            out.clear()
+        flush_bits(acc, nbits, out)
+        f2.write(out + index_to_bytes(index))
+
+
+# Memory-mapped versions of compress_file and decompress_file: the input is
+# read through a memoryview over the mapped file instead of being copied into
+# a bytes object, and the output size is known up front (from the code
+# lengths when compressing, from the header when decompressing), so the
+# output file is preallocated and mapped as well.
+
+def _write_mapped(out_file: str, size: int) -> tuple[BinaryIO, mmap.mmap]:
+    f = open(out_file, "wb+")
+    f.truncate(size)
+    return f, mmap.mmap(f.fileno(), size)
+
+
+def compress_file_mmap(in_file: str, out_file: str,
+                       canonical: bool = False,
+                       max_code_length: int = 0,
+                       allow_stored: bool = True) -> None:
+    if os.path.getsize(in_file) == 0:  # an empty file cannot be mapped
+        compress_file(in_file, out_file, canonical,
+                      max_code_length=max_code_length,
+                      allow_stored=allow_stored)
+        return
+    with open(in_file, "rb") as f1, \
+            mmap.mmap(f1.fileno(), 0, access=mmap.ACCESS_READ) as in_map, \
+            memoryview(in_map) as text:
+        freq = build_frequency_dict_fast(text)
+        stored, _, header, pairs = _choose_codes(freq, canonical,
+                                                 max_code_length,
+                                                 allow_stored)
+        if stored:
+            header = stored_header(len(text))
+            f2, out_map = _write_mapped(out_file, len(header) + len(text))
+            with f2, out_map:
+                out_map.write(header)
+                out_map.write(text)
+            return
+        header += int32_to_bytes(len(text))
+        num_bits = sum(pairs[1][sym] * freq[sym] for sym in freq)
+
+        f2, out_map = _write_mapped(out_file, len(header) + (num_bits + 7) // 8)
+        with f2, out_map:
+            out_map.write(header)
+            acc, nbits, out = 0, 0, bytearray()
+            for i in range(0, len(text), CHUNK_SIZE):
+                acc, nbits = pack_codes(text[i:i + CHUNK_SIZE], pairs,
+                                        acc, nbits, out)
+                out_map.write(out)
+                out.clear()
+            flush_bits(acc, nbits, out)
+            out_map.write(out)
 
 
 # ====================
@@ -237,17 +955,265 @@ def decompress_bytes(tree: HuffmanTree, text: bytes, size: int) -> bytes:
     return bytes(list_of_bytes)
 
 
+# Table-driven decoding: every internal node of the tree is a decoder state,
+# and one table lookup per input byte gives the symbols emitted while walking
+# those 8 bits plus the state the walk ends in.
+
+DECODE_CHUNK = 1 << 16
+
+
+def flatten_tree(tree: HuffmanTree) -> tuple[list[int], list[int]]:
+    # internal nodes are numbered from 0 (the root), a leaf child is
+    # stored as ~symbol so it is always negative
+    flat = FlatTree.from_tree(tree)
+    return flat.left, flat.right
+
+
+def build_decode_table(left: list[int], right: list[int],
+                       symbol_bytes: int = 1) \
+        -> tuple[list[bytes], list[int]]:
+    emit = [b''] * (len(left) << 8)
+    next_state = [0] * (len(left) << 8)
+
+    for state in range(len(left)):
+        # extend every bit prefix by one bit until all 8-bit prefixes are
+        # known, so entry i of level is the walk for byte value i
+        level = [(state, b'')]
+        for _ in range(8):
+            new_level = []
+            for node, out in level:
+                for child in (left[node], right[node]):
+                    if child < 0:
+                        new_level.append((0, out + (~child).to_bytes(
+                            symbol_bytes, "little")))
+                    else:
+                        new_level.append((child, out))
+            level = new_level
+
+        base = state << 8
+        for byte, (node, out) in enumerate(level):
+            emit[base + byte] = out
+            next_state[base + byte] = node << 8
+    return emit, next_state
+
+
+def table_decode(table: tuple[list[bytes], list[int]], text: bytes,
+                 state: int, out: bytearray) -> int:
+    emit, next_state = table
+    for byte in text:
+        i = state | byte
+        out += emit[i]
+        state = next_state[i]
+    return state
+
+
+def decompress_bytes_table(tree: HuffmanTree, text: bytes,
+                           size: int) -> bytes:
+    if size == 0:
+        return b''
+    return decode_all(build_decode_table(*flatten_tree(tree)), text, size)
+
+
+def decode_all(table: tuple[list[bytes], list[int]], text: bytes,
+               size: int) -> bytes:
+    view, out, state = memoryview(text), bytearray(), 0
+    for i in range(0, len(view), DECODE_CHUNK):
+        state = table_decode(table, view[i:i + DECODE_CHUNK], state, out)
+        if len(out) >= size:
+            break
+    if len(out) < size:
+        raise ValueError(f"the data ends after {len(out)} of {size} bytes")
+    # the padding bits of the last byte may decode to extra symbols
+    del out[size:]
+    return bytes(out)
+
+
+def _read_header(f: BinaryIO) \
+        -> tuple[Optional[tuple[list[int], list[int]]], int]:
+    # returns the flattened code tree, None for a stored file, and the
+    # original size
+    num_nodes = read_exactly(f, 1)[0]
+    if num_nodes == 0:
+        version = read_exactly(f, 1)[0]
+        if version == VERSION_STORED:
+            return None, bytes_to_int(read_exactly(f, 4))
+        if version != VERSION_CANONICAL:
+            raise ValueError(f"unsupported .huff format version {version}")
+        flat = canonical_flat_tree(read_canonical_header(f))
+    else:
+        # no HuffmanTree is built, see generate_tree_general for that
+        nodes = read_exactly(f, num_nodes * 4)
+        tree = FlatTree.from_postorder(nodes)
+        flat = tree.left, tree.right
+        size = f.read(4)
+        if num_nodes == 1 and nodes == bytes(4) and not size:
+            # an empty input is written as a node count of 1 with no node
+            # table, so its zero size was read as the table
+            return flat, 0
+        if len(size) != 4:
+            raise ValueError("the .huff file is truncated")
+        return flat, bytes_to_int(size)
+    return flat, bytes_to_int(read_exactly(f, 4))
+
+
 def decompress_file(in_file: str, out_file: str) -> None:
-    with open(in_file, "rb") as f:
-        num_nodes = f.read(1)[0]
-        buf = f.read(num_nodes * 4)
-        node_lst = bytes_to_nodes(buf)
-        # use generate_tree_general or generate_tree_postorder here
-        tree = generate_tree_general(node_lst, num_nodes - 1)
-        size = bytes_to_int(f.read(4))
-        with open(out_file, "wb") as g:
-            text = f.read()
-            g.write(decompress_bytes(tree, text, size))
+    with _stage("read") as stage, open(in_file, "rb") as f:
+        flat, size = _read_header(f)
+        text = f.read()
+        stage.bytes_out = f.tell()
+    result = b""
+    if flat is None:
+        if len(text) < size:
+            raise ValueError(f"the data ends after {len(text)} of {size} "
+                             f"bytes")
+        result = text[:size]
+    elif size:
+        with _stage("build"):
+            table = build_decode_table(*flat)
+        with _stage("decode") as stage:
+            result = decode_all(table, text, size)
+            stage.bytes_in, stage.bytes_out = len(text), len(result)
+    with _stage("write") as stage, open(out_file, "wb") as g:
+        g.write(result)
+        stage.bytes_in = stage.bytes_out = len(result)
+
+
+def decompress_stream(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    # decode a .huff file given as a stream of chunks, yielding the
+    # original bytes as they are decoded
+    f = ChunkReader(chunks)
+    flat, size = _read_header(f)
+    remaining = size
+    if flat is None:
+        for chunk in f:
+            if remaining <= 0:
+                break
+            yield chunk[:remaining]
+            remaining -= len(chunk[:remaining])
+    else:
+        table = build_decode_table(*flat)
+        state, out = 0, bytearray()
+        for chunk in f:
+            if remaining <= 0:
+                break
+            state = table_decode(table, chunk, state, out)
+            # the padding bits of the last byte may decode to extra symbols
+            del out[remaining:]
+            remaining -= len(out)
+            yield bytes(out)
+            out.clear()
+    if remaining > 0:
+        raise ValueError(f"the data ends after {size - remaining} of {size} "
+                         f"bytes")
+
+
+def decompress_file_stream(in_file: str, out_file: str,
+                           chunk_size: int = CHUNK_SIZE,
+                           progress: Optional[Progress] = None) -> None:
+    try:
+        with open(in_file, "rb") as f, open(out_file, "wb") as g:
+            chunks = _with_progress(read_chunks(f, chunk_size), progress,
+                                    os.path.getsize(in_file))
+            for piece in decompress_stream(chunks):
+                g.write(piece)
+    except ValueError:
+        # do not leave the part that decoded looking like a whole file
+        os.remove(out_file)
+        raise
+
+
+def decompress_file_mmap(in_file: str, out_file: str) -> None:
+    with open(in_file, "rb") as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as in_map:
+        flat, size = _read_header(in_map)
+        if size == 0:  # an empty file cannot be mapped
+            open(out_file, "wb").close()
+            return
+        table = None if flat is None else build_decode_table(*flat)
+
+        g, out_map = _write_mapped(out_file, size)
+        with g, out_map, memoryview(in_map) as text:
+            if table is None:
+                start = in_map.tell()
+                out_map.write(text[start:start + size])
+            else:
+                state, out = 0, bytearray()
+                for i in range(in_map.tell(), len(text), CHUNK_SIZE):
+                    state = table_decode(table, text[i:i + CHUNK_SIZE], state,
+                                         out)
+                    # the padding bits of the last byte may decode to extra
+                    # symbols
+                    del out[size - out_map.tell():]
+                    out_map.write(out)
+                    out.clear()
+                    if out_map.tell() == size:
+                        break
+            written = out_map.tell()
+    if written < size:
+        # the rest of the preallocated output would be zeros
+        os.remove(out_file)
+        raise ValueError(f"the data ends after {written} of {size} bytes")
+
+
+# Random access through the index written by index_interval: decoding
+# starts at the last checkpoint at or before the requested offset.
+
+def read_index(f: BinaryIO) -> list[tuple[int, int]]:
+    # an empty list if the file has no index
+    f.seek(0, os.SEEK_END)
+    file_size = f.tell()
+    if file_size < 8:
+        return []
+    f.seek(file_size - 8)
+    trailer = f.read(8)
+    count = bytes_to_int(trailer[:4])
+    if trailer[4:] != INDEX_MAGIC or 16 * count + 8 > file_size:
+        return []
+    f.seek(file_size - 8 - 16 * count)
+    buf = f.read(16 * count)
+    return [(bytes_to_int(buf[i:i + 8]), bytes_to_int(buf[i + 8:i + 16]))
+            for i in range(0, len(buf), 16)]
+
+
+def _walk_bits(flat: tuple[list[int], list[int]], byte: int, first_bit: int,
+               out: bytearray) -> int:
+    # decode the bits of byte from bit first_bit (0 is the leftmost) on,
+    # starting at the root; returns the decoder state for table_decode
+    left, right = flat
+    node = 0
+    for shift in range(7 - first_bit, -1, -1):
+        child = (right if byte >> shift & 1 else left)[node]
+        if child < 0:
+            out.append(~child)
+            node = 0
+        else:
+            node = child
+    return node << 8
+
+
+def read_range(path: str, start: int, length: int) -> bytes:
+    with open(path, "rb") as f:
+        flat, size = _read_header(f)
+        end = min(start + length, size)
+        if start >= end:
+            return b""
+        if flat is None:
+            f.seek(start, os.SEEK_CUR)
+            return f.read(end - start)
+        checkpoints = [(0, f.tell() * 8)] + read_index(f)
+        offset, bit_offset = checkpoints[
+            bisect.bisect_right(checkpoints, (start, math.inf)) - 1]
+
+        f.seek(bit_offset // 8)
+        out = bytearray()
+        state = _walk_bits(flat, f.read(1)[0], bit_offset % 8, out)
+        table = build_decode_table(*flat)
+        while len(out) < end - offset:
+            chunk = f.read(DECODE_CHUNK)
+            if not chunk:
+                break
+            state = table_decode(table, chunk, state, out)
+    return bytes(out[start - offset:end - offset])
 
 
 # ====================
@@ -256,13 +1222,7 @@ def decompress_file(in_file: str, out_file: str) -> None:
 def improve_tree(tree: HuffmanTree, freq_dict: dict[int, int]) -> None:
     # from lecture on queues and trees (level order traversal)
     sorted_freq_dict = sorted([(freq_dict[key], key) for key in freq_dict])
-    tree_list = [tree]
 
-    while tree_list:
-        subtree = tree_list.pop(0)
+    for subtree in level_order(tree):
         if subtree.is_leaf():
             subtree.symbol = sorted_freq_dict.pop()[1]
-        if subtree.left is not None:
-            tree_list.append(subtree.left)
-        if subtree.right is not None:
-            tree_list.append(subtree.right)
@@ -0,0 +1,150 @@
+"""
+Pretrained Huffman trees ("dictionaries") for many small, similar files.
+
+A dictionary is a set of canonical code lengths trained once on a corpus and
+saved as NAME.hdict in a dictionary directory:
+
+    DICTIONARY_MAGIC, code lengths (compress2.lengths_to_bytes)
+
+Every byte value gets a code, so any input can be coded with any dictionary.
+A file compressed with a dictionary stores its id instead of a tree:
+
+    0, VERSION_DICTIONARY, dictionary id (4 bytes), original size (4 bytes)
+    compressed bits
+
+The id is the CRC-32 of the code lengths, so decoding with the wrong
+dictionary is caught instead of producing garbage.
+
+Train with:  python dictionary.py NAME DIRECTORY FILE [FILE ...]
+"""
+from __future__ import annotations
+
+import argparse
+import functools
+import io
+import os
+import zlib
+from typing import Iterable
+
+from compress2 import *
+
+VERSION_DICTIONARY = 4
+DICTIONARY_MAGIC = b"HDCT"
+DICTIONARY_SUFFIX = ".hdict"
+
+
+def train_dictionary(paths: Iterable[str]) -> bytes:
+    """ Return the code lengths of a tree built from the byte frequencies of
+    all files in <paths>. Bytes that never occur are counted once, so they
+    still get a (long) code.
+    """
+    freq = dict.fromkeys(range(256), 1)
+    for path in paths:
+        with open(path, "rb") as f:
+            for chunk in read_chunks(f, CHUNK_SIZE):
+                for symbol, count in build_frequency_dict_fast(chunk).items():
+                    freq[symbol] += count
+    return lengths_to_bytes(code_lengths(build_huffman_tree_heap(freq)))
+
+
+def dictionary_id(lengths: bytes) -> int:
+    """ Return the id stored in files compressed with the code lengths
+    <lengths>.
+
+    >>> dictionary_id(b"")
+    0
+    """
+    return zlib.crc32(lengths)
+
+
+def save_dictionary(lengths: bytes, directory: str, name: str) -> str:
+    """ Save the code lengths <lengths> as the dictionary <name> in
+    <directory> and return its path.
+    """
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, name + DICTIONARY_SUFFIX)
+    with open(path, "wb") as f:
+        f.write(DICTIONARY_MAGIC + lengths)
+    return path
+
+
+def load_dictionary(path: str) -> bytes:
+    """ Return the code lengths saved in the dictionary file <path>.
+    Files are only read again after they change.
+    """
+    return _read_dictionary(path, os.stat(path).st_mtime_ns)
+
+
+@functools.lru_cache(maxsize=32)
+def _read_dictionary(path: str, mtime: int) -> bytes:
+    with open(path, "rb") as f:
+        if f.read(len(DICTIONARY_MAGIC)) != DICTIONARY_MAGIC:
+            raise ValueError(f"{path} is not a dictionary file")
+        # canonical lengths write back to the same bytes
+        return lengths_to_bytes(read_canonical_header(f))
+
+
+def find_dictionary(directory: str, dict_id: int) -> str:
+    """ Return the path of the dictionary with id <dict_id> in <directory>.
+    """
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if (name.endswith(DICTIONARY_SUFFIX)
+                and dictionary_id(load_dictionary(path)) == dict_id):
+            return path
+    raise ValueError(f"no dictionary with id {dict_id:08x} in {directory}")
+
+
+@functools.lru_cache(maxsize=32)
+def _dictionary_pairs(lengths: bytes) -> tuple[list[int], list[int]]:
+    return canonical_code_pairs(read_canonical_header(io.BytesIO(lengths)))
+
+
+@functools.lru_cache(maxsize=32)
+def _dictionary_table(lengths: bytes) -> tuple[list[bytes], list[int]]:
+    lengths_dict = read_canonical_header(io.BytesIO(lengths))
+    return build_decode_table(*canonical_flat_tree(lengths_dict))
+
+
+def compress_file_dictionary(in_file: str, out_file: str,
+                             dictionary: str) -> None:
+    """ Compress <in_file> into <out_file> with the codes of the dictionary
+    file <dictionary>. No frequencies are counted and no tree is built.
+    """
+    lengths = load_dictionary(dictionary)
+    with open(in_file, "rb") as f1:
+        text = f1.read()
+    result = bytearray([0, VERSION_DICTIONARY])
+    result += int32_to_bytes(dictionary_id(lengths))
+    result += int32_to_bytes(len(text))
+    acc, nbits = pack_codes(text, _dictionary_pairs(lengths), 0, 0, result)
+    flush_bits(acc, nbits, result)
+    with open(out_file, "wb") as f2:
+        f2.write(result)
+
+
+def decompress_file_dictionary(in_file: str, out_file: str,
+                               directory: str) -> None:
+    """ Decompress <in_file> into <out_file>, looking up the dictionary it
+    was compressed with in <directory>. Decode tables are kept between calls.
+    """
+    with open(in_file, "rb") as f:
+        if f.read(2) != bytes([0, VERSION_DICTIONARY]):
+            raise ValueError("not a dictionary .huff file")
+        dict_id = bytes_to_int(f.read(4))
+        size = bytes_to_int(f.read(4))
+        text = f.read()
+    lengths = load_dictionary(find_dictionary(directory, dict_id))
+    with open(out_file, "wb") as g:
+        if size:
+            g.write(decode_all(_dictionary_table(lengths), text, size))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Train a Huffman dictionary.")
+    parser.add_argument('name', help='name of the dictionary')
+    parser.add_argument('directory', help='dictionary directory')
+    parser.add_argument('files', nargs='+', help='training corpus')
+    args = parser.parse_args()
+    print(save_dictionary(train_dictionary(args.files), args.directory,
+                          args.name))
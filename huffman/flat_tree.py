@@ -0,0 +1,243 @@
+"""
+A Huffman tree stored in two flat arrays instead of linked node objects.
+
+Internal nodes are numbered from 0 (the root) in the order flatten_tree in
+compress2.py visits them. left[i] and right[i] are the children of node i:
+the node number of an internal child, or ~symbol (always negative) for a
+leaf. These are the node arrays that build_decode_table, table_decode and
+the other decoders in compress2.py already take.
+"""
+from __future__ import annotations
+
+from array import array
+from typing import Any
+
+from huffman import HuffmanTree
+
+
+def _typecode(largest: int) -> str:
+    """ Return the smallest signed array typecode that holds node numbers
+    and ~symbol for symbols and numbers up to <largest>.
+
+    >>> _typecode(255), _typecode(65535)
+    ('h', 'i')
+    """
+    return "h" if largest < 1 << 15 else "i"
+
+
+class FlatTree:
+    """ A Huffman tree with at least one internal node, as flat arrays.
+
+    Public Attributes:
+    ===========
+    left: the left child of each internal node, ~symbol for a leaf
+    right: the right child of each internal node, ~symbol for a leaf
+    """
+    left: array
+    right: array
+
+    def __init__(self, left: array, right: array) -> None:
+        """ Create a new FlatTree from the child arrays <left> and <right>."""
+        self.left, self.right = left, right
+
+    @classmethod
+    def from_tree(cls, tree: HuffmanTree) -> FlatTree:
+        """ Return the flat version of <tree>, whose leaves all have symbols.
+
+        >>> t = HuffmanTree(None, HuffmanTree(3), HuffmanTree(None,
+        ...                 HuffmanTree(1), HuffmanTree(2)))
+        >>> flat = FlatTree.from_tree(t)
+        >>> list(flat.left), list(flat.right)
+        ([-4, -2], [1, -3])
+        """
+        left, right = [0], [0]
+        tree_lst = [(tree, 0)]
+        while tree_lst:
+            node, index = tree_lst.pop()
+            for children, child in ((left, node.left), (right, node.right)):
+                # only leaves have symbols
+                if child.symbol is not None:
+                    children[index] = ~child.symbol
+                else:
+                    children[index] = len(left)
+                    tree_lst.append((child, len(left)))
+                    left.append(0)
+                    right.append(0)
+        typecode = _typecode(max(~min(left), ~min(right), len(left)))
+        return cls(array(typecode, left), array(typecode, right))
+
+    @classmethod
+    def from_postorder(cls, buf: bytes, symbol_bytes: int = 1) -> FlatTree:
+        """ Return the tree stored in the post-order node table <buf>, in one
+        pass and without recursion. Each node is a (type, data) pair for its
+        left and right child, where data is <symbol_bytes> bytes long.
+
+        In post-order the two subtrees of a node are the last two trees
+        finished before it, so they are popped off a stack, and the node
+        numbers in <buf> are only checked, not followed. The root (the last
+        node) becomes node 0, as build_decode_table expects.
+
+        Raise ValueError if <buf> is not a valid node table.
+
+        >>> flat = FlatTree.from_postorder(bytes([0, 1, 0, 2, 0, 3, 1, 0]))
+        >>> list(flat.left), list(flat.right)
+        ([-4, -2], [1, -3])
+        >>> FlatTree.from_postorder(bytes([0, 1, 1, 0]))
+        Traceback (most recent call last):
+        ...
+        ValueError: node 0 has a missing child
+        """
+        width = 1 + symbol_bytes
+        count = len(buf) // (2 * width)
+        if count == 0 or len(buf) != count * 2 * width:
+            raise ValueError(f"a node table of {len(buf)} bytes")
+        last = count - 1
+        left, right = [0] * count, [0] * count
+        finished = []
+        for number in range(count):
+            i = number * 2 * width
+            for children, pos in ((right, i + width), (left, i)):
+                kind = buf[pos]
+                data = buf[pos + 1] if symbol_bytes == 1 else \
+                    int.from_bytes(buf[pos + 1:pos + width], "little")
+                if kind == 0:
+                    children[last - number] = ~data
+                elif kind != 1:
+                    raise ValueError(f"node {number} has child type {kind}")
+                elif not finished:
+                    raise ValueError(f"node {number} has a missing child")
+                elif finished[-1] != data:
+                    raise ValueError(f"node {number} points to node {data} "
+                                     f"instead of {finished[-1]}")
+                else:
+                    children[last - number] = last - finished.pop()
+            finished.append(number)
+        if len(finished) > 1:
+            raise ValueError(f"nodes {finished[:-1]} have no parent")
+        typecode = "h" if symbol_bytes == 1 else _typecode(1 << 16)
+        return cls(array(typecode, left), array(typecode, right))
+
+    def __eq__(self, other: Any) -> bool:
+        """ Return True iff <other> is a FlatTree with the same shape and
+        symbols as this one.
+
+        >>> t = HuffmanTree(None, HuffmanTree(1), HuffmanTree(2))
+        >>> FlatTree.from_tree(t) == FlatTree.from_postorder(bytes([0, 1, 0, 2]))
+        True
+        """
+        return (isinstance(other, FlatTree)
+                and list(self.left) == list(other.left)
+                and list(self.right) == list(other.right))
+
+    def __repr__(self) -> str:
+        """ Return constructor-style string representation of this FlatTree.
+        """
+        return f'FlatTree({self.left!r}, {self.right!r})'
+
+    def to_tree(self) -> HuffmanTree:
+        """ Return this tree as linked HuffmanTree nodes.
+
+        >>> t = HuffmanTree(None, HuffmanTree(3), HuffmanTree(None,
+        ...                 HuffmanTree(1), HuffmanTree(2)))
+        >>> FlatTree.from_tree(t).to_tree() == t
+        True
+        """
+        nodes = [HuffmanTree(None) for _ in self.left]
+        for index, node in enumerate(nodes):
+            left, right = self.left[index], self.right[index]
+            node.left = HuffmanTree(~left) if left < 0 else nodes[left]
+            node.right = HuffmanTree(~right) if right < 0 else nodes[right]
+        return nodes[0]
+
+    def postorder(self) -> list[int]:
+        """ Return the internal nodes in post-order: left subtree, right
+        subtree, then the node itself.
+        """
+        order, tree_lst = [], [0]
+        while tree_lst:
+            # node, right subtree, left subtree, reversed at the end
+            index = tree_lst.pop()
+            order.append(index)
+            for child in (self.left[index], self.right[index]):
+                if child >= 0:
+                    tree_lst.append(child)
+        order.reverse()
+        return order
+
+    def number_nodes(self) -> list[int]:
+        """ Return the number number_nodes gives each internal node of the
+        HuffmanTree version of this tree, indexed by node.
+        """
+        numbers = [0] * len(self.left)
+        for number, index in enumerate(self.postorder()):
+            numbers[index] = number
+        return numbers
+
+    def num_nodes_to_bytes(self) -> bytes:
+        """ Return the number of internal nodes, like
+        HuffmanTree.num_nodes_to_bytes.
+        """
+        return bytes([len(self.left)])
+
+    def tree_to_bytes(self) -> bytes:
+        """ Return the same bytes as tree_to_bytes in compress2.py gives for
+        the numbered HuffmanTree version of this tree.
+
+        >>> t = HuffmanTree(None, HuffmanTree(3), HuffmanTree(None,
+        ...                 HuffmanTree(1), HuffmanTree(2)))
+        >>> list(FlatTree.from_tree(t).tree_to_bytes())
+        [0, 1, 0, 2, 0, 3, 1, 0]
+        """
+        left, right = self.left, self.right
+        # children come before their parent in post-order, so their numbers
+        # are known when the parent is written
+        numbers = [0] * len(left)
+        result = []
+        for number, index in enumerate(self.postorder()):
+            numbers[index] = number
+            child = left[index]
+            result += (0, ~child) if child < 0 else (1, numbers[child])
+            child = right[index]
+            result += (0, ~child) if child < 0 else (1, numbers[child])
+        return bytes(result)
+
+    def get_codes(self) -> dict[int, str]:
+        """ Return the code of each symbol, like get_codes in compress2.py.
+
+        >>> t = HuffmanTree(None, HuffmanTree(3), HuffmanTree(None,
+        ...                 HuffmanTree(1), HuffmanTree(2)))
+        >>> FlatTree.from_tree(t).get_codes()
+        {3: '0', 1: '10', 2: '11'}
+        """
+        codes, tree_lst = {}, [(0, '')]
+        while tree_lst:
+            child, code = tree_lst.pop()
+            if child < 0:
+                codes[~child] = code
+            else:
+                tree_lst.append((self.right[child], code + '1'))
+                tree_lst.append((self.left[child], code + '0'))
+        return codes
+
+    def code_pairs(self) -> tuple[list[int], list[int]]:
+        """ Return the (value, length) code of each symbol as two lists
+        indexed by symbol, like get_code_pairs in compress2.py.
+        """
+        size = max(-min(min(self.left), min(self.right)), 256)
+        values, lengths = [0] * size, [0] * size
+        tree_lst = [(0, 0, 0)]
+        while tree_lst:
+            index, value, length = tree_lst.pop()
+            for child, bit in ((self.left[index], 0), (self.right[index], 1)):
+                code = value << 1 | bit
+                if child < 0:
+                    values[~child], lengths[~child] = code, length + 1
+                else:
+                    tree_lst.append((child, code, length + 1))
+        return values, lengths
+
+
+if __name__ == '__main__':
+    import doctest
+
+    doctest.testmod()
@@ -30,6 +30,7 @@ class HuffmanTree:
     left: left subtree of this Huffman tree
     right: right subtree of this Huffman tree
     """
+    __slots__ = ('symbol', 'number', 'left', 'right')
     symbol: Optional[int]
     number: Optional[int]
     left: Optional[HuffmanTree]
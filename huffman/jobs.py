@@ -0,0 +1,221 @@
+"""
+Background jobs for the compression web service.
+
+Uploads are compressed or decompressed on a local process pool, so a web
+worker only has to save the upload and return a job id. The work itself is
+done by compress2 (or blocks, for block files).
+"""
+from __future__ import annotations
+
+import os
+import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ProcessPoolExecutor
+from multiprocessing import Manager
+from typing import Any, Optional
+
+import blocks
+import compress2
+
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+
+
+class JobQueueFull(Exception):
+    """ Raised when too many jobs are queued or running."""
+
+
+class JobTooLarge(Exception):
+    """ Raised when an upload is larger than the per-job limit."""
+
+
+def run_job(src: str, dst: str, job_id: str, progress: Any,
+            decompress: bool) -> None:
+    """ Compress <src> into <dst>, or decompress it if <decompress> is True,
+    storing the fraction done in progress[job_id].
+    """
+    def report(done: int, total: int) -> None:
+        progress[job_id] = done / total if total else 1.0
+
+    if not decompress:
+        compress2.compress_file_stream(src, dst, progress=report)
+    elif blocks.is_block_file(src):
+        blocks.decompress_file_blocks(src, dst, workers=1)
+    else:
+        compress2.decompress_file_stream(src, dst, progress=report)
+    progress[job_id] = 1.0
+
+
+class Job:
+    """ A compression or decompression job.
+
+    Public Attributes:
+    ===========
+    id: the job id
+    filename: the name of the uploaded file
+    result_name: the name of the result file
+    decompress: True if the upload is a .huff file to decompress
+    src: path of the uploaded file, under a fixed name so that no filename
+        can collide with dst
+    dst: path of the result file
+    size: size of the upload in bytes
+    future: the pool's future for this job
+    finished_at: time.monotonic() when the job finished, or None
+    """
+    id: str
+    filename: str
+    result_name: str
+    decompress: bool
+    src: str
+    dst: str
+    size: int
+    future: Optional[Future]
+    finished_at: Optional[float]
+
+    def __init__(self, job_id: str, filename: str, job_dir: str) -> None:
+        """ Create a new Job for the upload <filename> in <job_dir>."""
+        self.id, self.filename = job_id, filename
+        self.decompress = filename.endswith('.huff')
+        if self.decompress:
+            self.result_name = filename.rsplit('.', 1)[0]
+        else:
+            self.result_name = filename + '.huff'
+        self.src = os.path.join(job_dir, 'upload')
+        self.dst = os.path.join(job_dir, 'result.out')
+        self.size = 0
+        self.future = None
+        self.finished_at = None
+
+
+class JobQueue:
+    """ A queue of compression jobs run on a local process pool.
+
+    Public Attributes:
+    ===========
+    work_dir: directory holding one subdirectory per job
+    max_pending: the most jobs that may be queued or running at once
+    max_job_bytes: the largest upload accepted, in bytes
+    ttl: seconds a finished job and its files are kept
+    """
+    work_dir: str
+    max_pending: int
+    max_job_bytes: int
+    ttl: float
+    _jobs: dict[str, Job]
+
+    def __init__(self, work_dir: str, workers: Optional[int] = None,
+                 max_pending: int = 32,
+                 max_job_bytes: int = 1 << 30,
+                 ttl: float = 3600) -> None:
+        """ Create a new JobQueue that keeps its files in <work_dir>."""
+        self.work_dir = work_dir
+        self.max_pending = max_pending
+        self.max_job_bytes = max_job_bytes
+        self.ttl = ttl
+        self._pool = ProcessPoolExecutor(workers)
+        self._manager = Manager()
+        self._progress = self._manager.dict()
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def pending(self) -> int:
+        """ Return the number of jobs that are queued or running."""
+        # a snapshot, since reap and remove may pop jobs from other threads
+        return sum(1 for job in list(self._jobs.values())
+                   if job.future is None or not job.future.done())
+
+    def submit(self, upload: Any, filename: str,
+               size: Optional[int] = None) -> str:
+        """ Save <upload> (a file-like object or werkzeug FileStorage) as
+        <filename>, queue a job for it and return the job id. <size> is the
+        upload's size, if known before saving.
+        """
+        if size is not None and size > self.max_job_bytes:
+            raise JobTooLarge(f'{size} bytes is over the limit of '
+                              f'{self.max_job_bytes}')
+        job_id = uuid.uuid4().hex
+        self.reap()
+        with self._lock:
+            if self.pending() >= self.max_pending:
+                raise JobQueueFull(f'{self.max_pending} jobs are pending')
+            job_dir = os.path.join(self.work_dir, job_id)
+            os.makedirs(job_dir)
+            job = self._jobs[job_id] = Job(job_id, filename, job_dir)
+
+        try:
+            self._save(upload, job)
+        except Exception:
+            self.remove(job_id)
+            raise
+        self._progress[job_id] = 0.0
+        job.future = self._pool.submit(run_job, job.src, job.dst, job_id,
+                                       self._progress, job.decompress)
+        job.future.add_done_callback(
+            lambda _: setattr(job, 'finished_at', time.monotonic()))
+        return job_id
+
+    def reap(self) -> None:
+        """ Remove the jobs that finished more than ttl seconds ago, with
+        their files.
+        """
+        now = time.monotonic()
+        with self._lock:
+            expired = [job_id for job_id, job in self._jobs.items()
+                       if job.finished_at is not None
+                       and now - job.finished_at >= self.ttl]
+        for job_id in expired:
+            self.remove(job_id)
+
+    def _save(self, upload: Any, job: Job) -> None:
+        """ Copy <upload> to job.src, stopping at the size limit."""
+        stream = getattr(upload, 'stream', upload)
+        with open(job.src, 'wb') as f:
+            for chunk in iter(lambda: stream.read(compress2.CHUNK_SIZE), b''):
+                job.size += len(chunk)
+                if job.size > self.max_job_bytes:
+                    raise JobTooLarge(f'upload is over the limit of '
+                                      f'{self.max_job_bytes} bytes')
+                f.write(chunk)
+
+    def get(self, job_id: str) -> Optional[Job]:
+        """ Return the job with id <job_id>, or None."""
+        return self._jobs.get(job_id)
+
+    def progress(self, job_id: str) -> float:
+        """ Return the fraction of job <job_id> that is done."""
+        return self._progress.get(job_id, 0.0)
+
+    def status(self, job_id: str) -> Optional[dict[str, Any]]:
+        """ Return the status of job <job_id> as a dict, or None if there is
+        no such job.
+        """
+        job = self._jobs.get(job_id)
+        if job is None:
+            return None
+        result = {'id': job_id, 'filename': job.filename, 'size': job.size,
+                  'progress': self.progress(job_id)}
+        if job.future is None or not (job.future.running()
+                                      or job.future.done()):
+            result['status'] = QUEUED
+        elif job.future.running():
+            result['status'] = RUNNING
+        elif job.future.exception() is not None:
+            result['status'] = FAILED
+            result['error'] = str(job.future.exception())
+        else:
+            result['status'] = DONE
+        return result
+
+    def remove(self, job_id: str) -> None:
+        """ Forget job <job_id> and delete its files."""
+        with self._lock:
+            job = self._jobs.pop(job_id, None)
+        self._progress.pop(job_id, None)
+        if job is not None:
+            shutil.rmtree(os.path.dirname(job.src), ignore_errors=True)
+
+    def shutdown(self) -> None:
+        """ Wait for running jobs and stop the pool."""
+        self._pool.shutdown()
+        self._manager.shutdown()
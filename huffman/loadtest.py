@@ -0,0 +1,136 @@
+"""
+Load test comparing the Flask and ASGI versions of the web service.
+
+Many concurrent clients POST the same text file to /stream/<name> on each
+server, and the throughput and latencies are printed side by side. With
+--slow, each client spreads its upload over that many seconds, like clients
+on slow links: a Flask worker is held for all of that time, the ASGI event
+loop is not.
+
+Start the servers to compare, e.g. Flask with four sync workers (like the
+passenger_wsgi.py deployment) and the ASGI app with one event loop:
+
+    gunicorn -w 4 -b 127.0.0.1:8000 passenger_wsgi:application
+    uvicorn asgi:app --port 8001
+
+Run with:  python loadtest.py http://127.0.0.1:8000 http://127.0.0.1:8001
+               [--clients 64] [--requests 256] [--size 64K] [--slow 1]
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import sys
+import time
+from typing import Optional
+from urllib.parse import urlsplit
+
+from bench_huffman import make_text_corpus
+from bench_suite import format_size, parse_size
+
+# a slow upload is sent in this many pieces
+SLOW_PIECES = 10
+
+
+async def post(host: str, port: int, path: str, body: bytes,
+               slow: float) -> int:
+    """ POST <body> to <path> on <host>:<port>, spread over <slow> seconds,
+    read the whole response and return its status code.
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write(f'POST {path} HTTP/1.1\r\n'
+                     f'Host: {host}:{port}\r\n'
+                     f'Content-Type: application/octet-stream\r\n'
+                     f'Content-Length: {len(body)}\r\n'
+                     f'Connection: close\r\n\r\n'.encode())
+        if slow > 0:
+            step = -(-len(body) // SLOW_PIECES)
+            for i in range(0, len(body), step):
+                writer.write(body[i:i + step])
+                await writer.drain()
+                await asyncio.sleep(slow / SLOW_PIECES)
+        else:
+            writer.write(body)
+            await writer.drain()
+        status_line = await reader.readline()
+        await reader.read()  # the server closes the connection
+    finally:
+        writer.close()
+    return int(status_line.split()[1])
+
+
+async def run_load(url: str, body: bytes, clients: int, requests: int,
+                   slow: float) -> dict[str, object]:
+    """ Send <requests> uploads of <body> to the server at <url>, at most
+    <clients> at a time, and return the wall time, the number of failed
+    requests and the latency of each successful one.
+    """
+    parts = urlsplit(url)
+    host, port = parts.hostname or '127.0.0.1', parts.port or 80
+    limit = asyncio.Semaphore(clients)
+    latencies, failed = [], 0
+
+    async def one(i: int) -> None:
+        nonlocal failed
+        async with limit:
+            start = time.perf_counter()
+            try:
+                status = await post(host, port, f'/stream/load{i}.txt', body,
+                                    slow)
+            except OSError:
+                status = 0
+            if status == 200:
+                latencies.append(time.perf_counter() - start)
+            else:
+                failed += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(requests)))
+    return {'seconds': time.perf_counter() - start, 'failed': failed,
+            'latencies': sorted(latencies)}
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    """ Return the value below which <fraction> of the sorted <values> lie.
+
+    >>> percentile([1.0, 2.0, 3.0, 4.0], 0.5), percentile([], 0.5)
+    (3.0, 0.0)
+    """
+    if not values:
+        return 0.0
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('urls', nargs='+', help='servers to compare')
+    parser.add_argument('--clients', type=int, default=64,
+                        help='concurrent clients, default 64')
+    parser.add_argument('--requests', type=int, default=256,
+                        help='requests per server, default 256')
+    parser.add_argument('--size', default='64K',
+                        help='upload size, e.g. 64K or 1M')
+    parser.add_argument('--slow', type=float, default=0.0,
+                        help='seconds each client takes to send its upload')
+    args = parser.parse_args(argv)
+
+    body = make_text_corpus(parse_size(args.size))
+    print(f'{args.requests} uploads of {format_size(len(body))} by '
+          f'{args.clients} clients, {args.slow:g} s to send each')
+    failed = 0
+    for url in args.urls:
+        result = asyncio.run(run_load(url, body, args.clients, args.requests,
+                                      args.slow))
+        latencies, seconds = result['latencies'], result['seconds']
+        failed += result['failed']
+        print(f'{url}: {len(latencies) / seconds:.1f} req/s, '
+              f'{len(latencies) * len(body) / (1 << 20) / seconds:.2f} MB/s, '
+              f'latency p50 {percentile(latencies, 0.5) * 1000:.0f} ms, '
+              f'p95 {percentile(latencies, 0.95) * 1000:.0f} ms, '
+              f'{result["failed"]} failed', flush=True)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,190 @@
+"""
+16-bit symbol mode for Huffman compression.
+
+Each pair of input bytes (little-endian) is one symbol, so the tree can
+capture which bytes follow each other. A wide file looks like
+
+    0, VERSION_WIDE, number of internal nodes (4 bytes)
+    node table: like tree_to_bytes, but 6 bytes per node
+        (type, 2-byte symbol or node number, type, 2-byte symbol or number)
+    original size in bytes (4 bytes)
+    the last input byte, if the size is odd
+    compressed bits of the size // 2 symbols
+"""
+from __future__ import annotations
+
+import sys
+from array import array
+from collections import Counter
+
+from compress2 import *
+from flat_tree import FlatTree
+
+try:
+    import numpy as np
+except ImportError:  # numpy is optional, see build_frequency_dict_wide
+    np = None
+
+VERSION_WIDE = 3
+SYMBOL_BYTES = 2
+
+# above this many internal nodes the decode table is built lazily
+FULL_TABLE_STATES = 4096
+# and at most this many of its entries are kept at a time
+DECODE_CACHE_ENTRIES = 1 << 16
+# a tree over 65536 symbols has at most this many internal nodes
+MAX_NODES = (1 << 8 * SYMBOL_BYTES) - 1
+
+
+def wide_symbols(text: bytes) -> array:
+    """ Return the 16-bit symbols of <text>, ignoring a last odd byte.
+
+    >>> list(wide_symbols(bytes([1, 2, 3])))
+    [513]
+    """
+    symbols = array("H", bytes(text[:len(text) - len(text) % 2]))
+    if sys.byteorder == "big":
+        symbols.byteswap()
+    return symbols
+
+
+def build_frequency_dict_wide(symbols: array) -> dict[int, int]:
+    """ Return the frequency of each 16-bit symbol in <symbols>, with keys in
+    order of first appearance like build_frequency_dict.
+    """
+    if np is None:
+        return dict(Counter(symbols))
+    counts = np.bincount(np.frombuffer(symbols, dtype=np.uint16),
+                         minlength=1 << 16)
+    num_symbols = int(np.count_nonzero(counts))
+    order = {}
+    for i in range(0, len(symbols), DECODE_CHUNK):
+        order.update(dict.fromkeys(symbols[i:i + DECODE_CHUNK]))
+        if len(order) == num_symbols:
+            break
+    return {sym: int(counts[sym]) for sym in order}
+
+
+def tree_to_bytes_wide(tree: HuffmanTree) -> bytes:
+    """ Return the node table of the numbered tree <tree>, in node number
+    (post-order) order, with 2-byte symbols and node numbers.
+    """
+    nodes = [tree] * (tree.number + 1)
+    tree_lst = [tree]
+    while tree_lst:
+        node = tree_lst.pop()
+        if not node.is_leaf():
+            nodes[node.number] = node
+            tree_lst.extend((node.left, node.right))
+
+    result = bytearray()
+    for node in nodes:
+        for child in (node.left, node.right):
+            if child.is_leaf():
+                result += bytes([0]) + child.symbol.to_bytes(2, "little")
+            else:
+                result += bytes([1]) + child.number.to_bytes(2, "little")
+    return bytes(result)
+
+
+def bytes_to_flat_wide(buf: bytes) -> tuple[array, array]:
+    """ Return the node arrays used by flatten_tree for the node table <buf>,
+    with the root as node 0. Raise ValueError if <buf> is malformed.
+    """
+    if not buf:  # the input had no whole symbol
+        return array("i"), array("i")
+    flat = FlatTree.from_postorder(buf, SYMBOL_BYTES)
+    return flat.left, flat.right
+
+
+def _wide_decode(flat: tuple[list[int], list[int]],
+                 cache: dict[int, tuple[bytes, int]], text: bytes,
+                 state: int, out: bytearray) -> int:
+    """ Decode <text> like table_decode, from decoder state <state>.
+    A full table for up to 65535 states would have 16M entries, so for large
+    trees entries are only built the first time they are used, and kept in
+    <cache>, keyed on (state, byte). The cache is emptied when it reaches
+    DECODE_CACHE_ENTRIES, so memory does not grow with the input.
+    """
+    left, right = flat
+    for byte in text:
+        i = state | byte
+        entry = cache.get(i)
+        if entry is None:
+            node, emitted = state >> 8, bytearray()
+            for shift in range(7, -1, -1):
+                child = (right if byte >> shift & 1 else left)[node]
+                if child < 0:
+                    emitted += (~child).to_bytes(SYMBOL_BYTES, "little")
+                    node = 0
+                else:
+                    node = child
+            if len(cache) >= DECODE_CACHE_ENTRIES:
+                cache.clear()
+            entry = cache[i] = (bytes(emitted), node << 8)
+        out += entry[0]
+        state = entry[1]
+    return state
+
+
+def compress_file_wide(in_file: str, out_file: str) -> None:
+    """ Compress <in_file> into <out_file> with 16-bit symbols."""
+    with open(in_file, "rb") as f1:
+        text = f1.read()
+    symbols = wide_symbols(text)
+    freq = build_frequency_dict_wide(symbols)
+    if len(freq) == 1:
+        # build_huffman_tree picks a byte-sized dummy symbol, which may be
+        # 65536 here; a second symbol that never occurs avoids that
+        freq[next(iter(freq)) ^ 1] = 0
+
+    result = bytearray([0, VERSION_WIDE])
+    if freq:
+        tree = build_huffman_tree_heap(freq)
+        pairs = get_code_arrays(tree)
+        number_nodes(tree)
+        record_bits_per_symbol(avg_length(tree, freq) / SYMBOL_BYTES)
+        result += int32_to_bytes(tree.number + 1) + tree_to_bytes_wide(tree)
+    else:
+        result += int32_to_bytes(0)
+    result += int32_to_bytes(len(text)) + text[len(symbols) * SYMBOL_BYTES:]
+    if freq:
+        acc, nbits = pack_codes(symbols, pairs, 0, 0, result)
+        flush_bits(acc, nbits, result)
+    with open(out_file, "wb") as f2:
+        f2.write(result)
+
+
+def decompress_file_wide(in_file: str, out_file: str) -> None:
+    """ Decompress the wide file <in_file> into <out_file>."""
+    with open(in_file, "rb") as f:
+        if f.read(2) != bytes([0, VERSION_WIDE]):
+            raise ValueError("not a 16-bit symbol .huff file")
+        num_nodes = bytes_to_int(read_exactly(f, 4))
+        if num_nodes > MAX_NODES:  # checked before reading that many bytes
+            raise ValueError(f"a wide file has at most {MAX_NODES} nodes, "
+                             f"not {num_nodes}")
+        flat = bytes_to_flat_wide(read_exactly(f, num_nodes * 6))
+        size = bytes_to_int(read_exactly(f, 4))
+        tail = read_exactly(f, size % SYMBOL_BYTES)
+        size -= len(tail)
+        if not num_nodes and size:
+            raise ValueError("a wide file with symbols but no tree")
+
+        table = None
+        if len(flat[0]) <= FULL_TABLE_STATES:
+            table = build_decode_table(*flat, SYMBOL_BYTES)
+        state, cache, out = 0, {}, bytearray()
+        for chunk in read_chunks(f, DECODE_CHUNK):
+            if len(out) >= size:
+                break
+            if table is None:
+                state = _wide_decode(flat, cache, chunk, state, out)
+            else:
+                state = table_decode(table, chunk, state, out)
+    if len(out) < size:
+        raise ValueError(f"the data ends after {len(out)} of {size} bytes")
+    # the padding bits of the last byte may decode to extra symbols
+    del out[size:]
+    with open(out_file, "wb") as g:
+        g.write(out + tail)